@@ -0,0 +1,283 @@
+# Access to food sites from the tract travel time matrices, as memory-mapped numpy arrays
+
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from gtfs_tables import file_sha256
+from raptor import project
+
+MATRIX_VERSION = 1  # Increase when the layout of the folder changes
+ROUTE_FILES = {"TRANSIT": "data/all_routes_transit_final.csv", "CAR": "data/all_routes_car_final.csv"}
+DATES = ["2021-09-15", "2021-09-19"]  # Weekday rush hour and weekend dates of access_analysis.R
+# Ratio of the 2019 INRIX off-peak (32) and peak (18) speeds for Washington DC, applied to car trips at rush hour
+CAR_RUSH_FACTOR = 1.78
+SITE_TYPES = ["snap", "non_snap", "retail", "charitable", "char_open", "char_child", "char_sen"]
+
+
+def read_routes(path, dates=DATES):
+    # Description: Reads the travel times of one mode, from raptor.py or conduct_routing.R
+    #     Tables without a date column, like all_routes_car_final.csv, are used for every date, as in access_analysis.R
+    # Input: path to all_routes_*_final.csv, and list of YYYY-MM-DD dates
+    # Output: pandas dataframe of geoid_start, geoid_end, date and adj_duration in minutes
+    routes = pd.read_csv(path, dtype={"geoid_start": str, "geoid_end": str, "date": str})
+    routes = routes.loc[routes["geoid_start"].notnull().values & routes["geoid_end"].notnull().values]
+    if "date" not in routes.columns:
+        routes = pd.concat([routes.assign(date=date) for date in dates], ignore_index=True)
+    return routes.loc[routes["date"].isin(dates).values, ["geoid_start", "geoid_end", "date", "adj_duration"]]
+
+
+def _source_meta(path):
+    # Description: Records the size, modification time and hash of a routes file, to tell when it changes
+    # Input: path to file
+    # Output: dict
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_sha256(path)}
+
+
+def write_matrices(route_files, matrix_path, dates=DATES):
+    # Description: Builds one dense origin x destination matrix of travel times per mode and date, as raw float32
+    #     files. Origins are the tracts routed from, destinations are every tract routed to or from, so that a tract
+    #     reaches itself in 0 minutes, as in access_analysis.R. Pairs that were not routed or not reached are NaN.
+    #     The folder is written under a temporary name and moved into place, so readers never see a partial matrix
+    # Input: dict of mode to path of all_routes_*_final.csv, folder of the matrices, and list of YYYY-MM-DD dates
+    # Output: path to the folder
+    routes = {mode: read_routes(path, dates) for mode, path in route_files.items()}
+    origins = np.unique(np.concatenate([r["geoid_start"].values for r in routes.values()]).astype(str))
+    destinations = np.union1d(origins, np.concatenate([r["geoid_end"].values for r in routes.values()]).astype(str))
+    tmp_path = matrix_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    meta = {"version": MATRIX_VERSION, "origins": origins.tolist(), "destinations": destinations.tolist(),
+            "sources": {mode: _source_meta(path) for mode, path in route_files.items()}, "matrices": {}}
+    self_pairs = np.searchsorted(destinations, origins)
+    for mode, table in routes.items():
+        meta["matrices"][mode] = []
+        for date in dates:
+            rows = table.loc[(table["date"] == date).values]
+            matrix = np.memmap(os.path.join(tmp_path, "{}.{}.f32".format(mode, date)), dtype=np.float32, mode="w+",
+                               shape=(len(origins), len(destinations)))
+            matrix[:] = np.nan
+            matrix[np.searchsorted(origins, rows["geoid_start"].values.astype(str)),
+                   np.searchsorted(destinations, rows["geoid_end"].values.astype(str))] = rows["adj_duration"].values
+            matrix[np.arange(len(origins)), self_pairs] = 0
+            matrix.flush()
+            del matrix
+            meta["matrices"][mode].append(date)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    if os.path.exists(matrix_path):
+        shutil.rmtree(matrix_path)
+    os.replace(tmp_path, matrix_path)
+    return matrix_path
+
+
+def matrices_up_to_date(route_files, matrix_path, dates=DATES):
+    # Description: Checks whether the matrices were built from the current routes files, for the same dates
+    #     A routes file is only hashed if its size or modification time changed
+    # Input: dict of mode to path of all_routes_*_final.csv, folder of the matrices, and list of YYYY-MM-DD dates
+    # Output: Boolean True if the matrices can be used
+    meta_path = os.path.join(matrix_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta["version"] != MATRIX_VERSION or sorted(meta["sources"]) != sorted(route_files):
+        return False
+    for mode, path in route_files.items():
+        source = meta["sources"][mode]
+        if meta["matrices"][mode] != list(dates) or source["path"] != path or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != source["size"]:
+            return False
+        if stat.st_mtime_ns != source["mtime_ns"] and file_sha256(path) != source["sha256"]:
+            return False
+    return True
+
+
+def load_matrices(route_files, matrix_path, dates=DATES, rebuild=True):
+    # Description: Loads the travel time matrices as read-only memory maps, rebuilding them if the routes changed
+    # Input:
+    #   - route_files: dict of mode to path of all_routes_*_final.csv
+    #   - matrix_path: folder of the matrices
+    #   - dates: list of YYYY-MM-DD dates
+    #   - rebuild: Boolean False to return None instead of rebuilding missing or stale matrices
+    # Output: dict with origins and destinations as numpy arrays of geoids, and matrices as a dict of (mode, date)
+    #     to 2d numpy float32 array of minutes, or None
+    if not matrices_up_to_date(route_files, matrix_path, dates):
+        if not rebuild:
+            return None
+        write_matrices(route_files, matrix_path, dates)
+    with open(os.path.join(matrix_path, "meta.json")) as f:
+        meta = json.load(f)
+    shape = (len(meta["origins"]), len(meta["destinations"]))
+    matrices = {(mode, date): np.memmap(os.path.join(matrix_path, "{}.{}.f32".format(mode, date)), dtype=np.float32,
+                                        mode="r", shape=shape)
+                for mode, mode_dates in meta["matrices"].items() for date in mode_dates}
+    return {"origins": np.array(meta["origins"]), "destinations": np.array(meta["destinations"]),
+            "matrices": matrices}
+
+
+def read_food_sites(retail_path, non_snap_path):
+    # Description: Reads the food sites, flagging the site types of access_analysis.R, plus the retailers that do not
+    #     take SNAP and all retailers
+    # Input: path to Food_retailers_TRANSPORT.csv, and path to non_snap-geocoded.csv
+    # Output: pandas dataframe of lat, lon and one Boolean column per site type of SITE_TYPES
+    retail = pd.read_csv(retail_path)
+    charitable = (retail["location_type"] == "Charitable food-site").values
+    sites = pd.DataFrame({"lat": retail["latitude"].values, "lon": retail["longitude"].values,
+                          "snap": (retail["location_type"] == "SNAP-retailer").values, "non_snap": False,
+                          "charitable": charitable,
+                          "char_open": charitable & (retail["eligibility_requirement"] == 0).values,
+                          "char_child": charitable & (retail["age_restrictions_for_children_or"] == 1).values,
+                          "char_sen": charitable & (retail["age_restrictions_for_seniors_onl"] == 1).values})
+    non_snap = pd.read_csv(non_snap_path)
+    sites = pd.concat([sites, pd.DataFrame({"lat": non_snap["Latitude"].values, "lon": non_snap["Longitude"].values,
+                                            "non_snap": True})], ignore_index=True)
+    sites = sites.fillna(False)
+    sites["retail"] = sites["snap"] | sites["non_snap"]
+    return sites[["lat", "lon"] + SITE_TYPES]
+
+
+def tract_centroids(pairs):
+    # Description: Coordinates of every tract in route_pairs.csv, as start or end of a pair
+    # Input: pandas dataframe with geoid_start, lat_start, lon_start, geoid_end, lat_end and lon_end
+    # Output: pandas dataframe of geoid, lat and lon, one row per tract
+    starts = pairs[["geoid_start", "lat_start", "lon_start"]].set_axis(["geoid", "lat", "lon"], axis=1)
+    ends = pairs[["geoid_end", "lat_end", "lon_end"]].set_axis(["geoid", "lat", "lon"], axis=1)
+    return pd.concat([starts, ends], ignore_index=True).drop_duplicates("geoid").reset_index(drop=True)
+
+
+def site_counts(sites, destinations, centroids, max_distance=5000):
+    # Description: Counts the food sites of each type in each destination tract. Without tract boundaries, a site is
+    #     placed in the tract with the nearest centroid, and left out if no centroid is within max_distance
+    # Input:
+    #   - sites: pandas dataframe from read_food_sites
+    #   - destinations: numpy array of the geoids of the matrix columns
+    #   - centroids: pandas dataframe from tract_centroids
+    #   - max_distance: meters
+    # Output: 2d numpy float32 array, one row per destination and one column per site type of SITE_TYPES
+    centroids = centroids.loc[centroids["geoid"].isin(destinations).values]
+    lat0 = centroids["lat"].mean()
+    cx, cy = project(centroids["lat"].values, centroids["lon"].values, lat0)
+    sx, sy = project(sites["lat"].values, sites["lon"].values, lat0)
+    distance = np.hypot(sx[:, None] - cx[None, :], sy[:, None] - cy[None, :])
+    nearest = distance.argmin(axis=1)
+    placed = distance[np.arange(len(sx)), nearest] <= max_distance
+    counts = np.zeros((len(destinations), len(SITE_TYPES)), dtype=np.float32)
+    rows = np.searchsorted(destinations, centroids["geoid"].values.astype(str)[nearest[placed]])
+    np.add.at(counts, rows, sites.loc[placed, SITE_TYPES].values.astype(np.float32))
+    return counts
+
+
+def weighted_times(car, transit, transit_share):
+    # Description: Travel times weighted by the share of households of each origin that get around by transit,
+    #     like wt_duration in access_analysis.R. Pairs missing in either mode are NaN
+    # Input: 2d numpy arrays of car and transit minutes, and numpy array of the transit share of each origin, 0 to 1
+    # Output: 2d numpy float32 array of minutes
+    share = np.asarray(transit_share, dtype=np.float32)[:, None]
+    return car * (1 - share) + transit * share
+
+
+def time_to_closest(times, counts, scale=1.0):
+    # Description: Minutes from each origin to the nearest destination with a site of each type, for all types at
+    #     once, like travel_time_to_closest in analysis_functions.R. Times are multiplied by scale, e.g. the rush hour
+    #     car factor. As R's min with na.rm, origins that reach no site of a type get infinity
+    # Input: 2d numpy array of minutes, origins by destinations, 2d array of site counts from site_counts, and factor
+    # Output: 2d numpy float32 array, origins by site types
+    closest = np.full((times.shape[0], counts.shape[1]), np.inf, dtype=np.float32)
+    for k in range(counts.shape[1]):
+        has_site = counts[:, k] > 0
+        if has_site.any():
+            closest[:, k] = np.fmin.reduce(times[:, has_site], axis=1, initial=np.inf)
+    return closest * np.float32(scale)
+
+
+def count_within(times, counts, thresholds, scale=1.0):
+    # Description: Number of sites of each type reachable from each origin within each threshold, for all thresholds
+    #     and types in one matrix product, like count_accessible_within_t in analysis_functions.R. Scaling the times
+    #     is done by dividing the thresholds, so the matrix is never copied
+    # Input: 2d numpy array of minutes, origins by destinations, 2d array of site counts from site_counts, list of
+    #     thresholds in minutes, and factor the times are multiplied by
+    # Output: 3d numpy float32 array, thresholds by origins by site types
+    limits = np.asarray(thresholds, dtype=np.float32) / np.float32(scale)
+    reached = times[None, :, :] <= limits[:, None, None]  # NaN, for pairs not reached, is never within a threshold
+    return np.matmul(reached.astype(np.float32), counts)
+
+
+def access_table(access, counts, thresholds, scales=None, extra=None):
+    # Description: Time to the closest site and number of sites within each threshold, for every mode, date and site
+    #     type, as one long table
+    # Input:
+    #   - access: dict from load_matrices
+    #   - counts: 2d numpy array from site_counts
+    #   - thresholds: list of thresholds in minutes
+    #   - scales: dict of (mode, date) to the factor its times are multiplied by, 1 if not given
+    #   - extra: dict of (mode, date) to 2d numpy array of minutes, e.g. from weighted_times, or None
+    # Output: pandas dataframe of geoid_start, mode, date, site_type, min_duration, and count_<threshold> per threshold
+    scales = scales or {}
+    matrices = dict(access["matrices"])
+    matrices.update(extra or {})
+    origins = access["origins"]
+    tables = []
+    for (mode, date), times in matrices.items():
+        scale = scales.get((mode, date), 1.0)
+        closest = time_to_closest(times, counts, scale)
+        within = count_within(times, counts, thresholds, scale)
+        table = pd.DataFrame({"geoid_start": np.repeat(origins, len(SITE_TYPES)), "mode": mode, "date": date,
+                              "site_type": np.tile(SITE_TYPES, len(origins)), "min_duration": closest.ravel()})
+        for i, t in enumerate(thresholds):
+            table["count_{:g}".format(t)] = within[i].ravel().astype(int)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time to the closest food site and number of food sites within "
+                                                 "each threshold, from the travel times in data/all_routes_*_final.csv")
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[5, 10, 15, 20, 30, 45, 60],
+                        help="minutes within which sites are counted")
+    parser.add_argument("--car-factor", type=float, default=CAR_RUSH_FACTOR,
+                        help="factor car times are multiplied by on the rush hour dates")
+    parser.add_argument("--rush-dates", nargs="*", default=DATES[:1], help="YYYY-MM-DD dates of rush hour car trips")
+    parser.add_argument("--transit-share", default=None, metavar="CSV",
+                        help="CSV of GEOID and pct_no_car, as read_process_acs in analysis_functions.R returns, to add "
+                             "a WEIGHTED mode that mixes car and transit times like wt_duration")
+    parser.add_argument("--max-site-distance", type=float, default=5000,
+                        help="meters from a food site to the nearest tract centroid, beyond which it is left out")
+    parser.add_argument("--rebuild", action="store_true", help="build the matrices again, even if the routes are "
+                                                               "unchanged")
+    parser.add_argument("--out", default="data/food_access.csv")
+    args = parser.parse_args()
+
+    matrix_path = "data/access-matrix"
+    route_files = {mode: path for mode, path in ROUTE_FILES.items() if os.path.exists(path)}
+    t0 = time.perf_counter()
+    if args.rebuild or not matrices_up_to_date(route_files, matrix_path):
+        write_matrices(route_files, matrix_path)
+        print("Matrices built in {:.2f} s".format(time.perf_counter() - t0))
+    access = load_matrices(route_files, matrix_path, rebuild=False)
+    pairs = pd.read_csv("data/route_pairs.csv", dtype={"geoid_start": str, "geoid_end": str})
+    sites = read_food_sites("../Final food data/Food_retailers_TRANSPORT.csv", "../non_snap-geocoded.csv")
+    counts = site_counts(sites, access["destinations"], tract_centroids(pairs), args.max_site_distance)
+    print("{} food sites in {} destination tracts".format(len(sites.index), int((counts.sum(axis=1) > 0).sum())))
+
+    t0 = time.perf_counter()
+    scales = {("CAR", date): args.car_factor for date in args.rush_dates}
+    extra = {}
+    if args.transit_share is not None and "CAR" in route_files and "TRANSIT" in route_files:
+        acs = pd.read_csv(args.transit_share, dtype={"GEOID": str})
+        share = acs.set_index("GEOID")["pct_no_car"].reindex(access["origins"]).values / 100
+        for date in DATES:
+            car = access["matrices"][("CAR", date)] * np.float32(scales.get(("CAR", date), 1.0))
+            extra[("WEIGHTED", date)] = weighted_times(car, access["matrices"][("TRANSIT", date)], share)
+    table = access_table(access, counts, args.thresholds, scales, extra)
+    table.to_csv(args.out, index=False)
+    print("{} origins, {} modes and dates, {} site types and {} thresholds in {:.3f} s, written to {}".format(
+        len(access["origins"]), len(access["matrices"]) + len(extra), len(SITE_TYPES), len(args.thresholds),
+        time.perf_counter() - t0, args.out))
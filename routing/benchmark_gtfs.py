@@ -0,0 +1,161 @@
+# Benchmark the GTFS correction functions on synthetic data
+
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import correct_gtfs_data_state as cg
+from gtfs_tables import format_gtfs_time, read_gtfs_table
+from synthetic_gtfs import DEFECTS, make_feed
+
+
+def make_stop_times(n_trips, stops_per_trip=20, seed=0):
+    # Description: Builds a synthetic stop_times.txt file where every trip is missing its final stop time
+    #     Trips rotate through the three interpolation cases: no known times, one known time, and all other times known
+    # Input:
+    #   - n_trips: number of trips
+    #   - stops_per_trip: number of stops on each trip
+    #   - seed: random seed
+    # Output: bytes of the stop_times.txt file
+    rng = np.random.default_rng(seed)
+    trip_idx = np.repeat(np.arange(n_trips), stops_per_trip)
+    seq = np.tile(np.arange(1, stops_per_trip + 1), n_trips)
+    start = rng.integers(5 * 3600, 23 * 3600, n_trips)
+    seconds = start[trip_idx] + (seq - 1) * rng.integers(60, 300, len(seq))
+    times = format_gtfs_time(seconds)
+    case = trip_idx % 3
+    times[(case == 0) | ((case == 1) & (seq > 1)) | (seq == stops_per_trip)] = ""
+    stimes = pd.DataFrame({"trip_id": pd.Series(trip_idx).astype(str).radd("T"),
+                           "arrival_time": times,
+                           "departure_time": times,
+                           "stop_id": pd.Series(rng.integers(0, 5000, len(seq))).astype(str),
+                           "stop_sequence": seq})
+    return stimes.to_csv(index=False).encode('utf-8')
+
+
+def bench_read_table(sizes=(1000, 5000, 25000, 100000)):
+    # Description: Times read_gtfs_table against an untyped pandas read for increasing numbers of trips
+    # Input: list of trip counts
+    # Output: pandas dataframe with rows, seconds, rows per second and resident size of each reader
+    results = []
+    for n_trips in sizes:
+        stimes = make_stop_times(n_trips)
+        for reader, read in [("pandas", pd.read_csv), ("read_gtfs_table", read_gtfs_table)]:
+            t0 = time.perf_counter()
+            table = read(BytesIO(stimes))
+            elapsed = time.perf_counter() - t0
+            results.append({"reader": reader, "trips": n_trips, "rows": len(table.index),
+                            "seconds": round(elapsed, 3), "rows_per_second": int(len(table.index) / elapsed),
+                            "mb": round(table.memory_usage(deep=True).sum() / 1e6, 1)})
+    return pd.DataFrame(results)
+
+
+def bench_interp_stop_times(sizes=(1000, 5000, 25000, 100000)):
+    # Description: Times check_stop_times and interp_stop_times for increasing numbers of trips
+    # Input: list of trip counts
+    # Output: pandas dataframe with rows, seconds and rows per second for each size
+    results = []
+    for n_trips in sizes:
+        stimes = read_gtfs_table(BytesIO(make_stop_times(n_trips)))
+        check_st, st_dset = cg.check_stop_times(stimes)
+        t0 = time.perf_counter()
+        cg.interp_stop_times(st_dset)
+        elapsed = time.perf_counter() - t0
+        results.append({"trips": n_trips, "rows": len(stimes.index), "seconds": round(elapsed, 3),
+                        "rows_per_second": int(len(stimes.index) / elapsed)})
+    results = pd.DataFrame(results)
+    # Constant microseconds per row means the interpolation scales linearly
+    results["us_per_row"] = (1e6 * results["seconds"] / results["rows"]).round(3)
+    return results
+
+
+def _measure(func, setup=lambda: ()):
+    # Description: Times a function, then runs it again under tracemalloc for its peak memory
+    #     The two runs are kept apart because tracing slows down the Python parts of the function
+    # Input: function to measure, and function that returns fresh arguments for each run (not measured)
+    # Output: seconds, and peak memory allocated by the function in MB
+    args = setup()
+    t0 = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - t0
+    args = setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak / 1e6
+
+
+def bench_checks(sizes=(20, 100, 500), trips_per_route=50, stops_per_trip=30, defects=DEFECTS):
+    # Description: Times each check and fix of clean_zipfile, and clean_zipfile as a whole,
+    #     on synthetic feeds with the given errors for increasing numbers of routes
+    # Input:
+    #   - sizes: list of route counts
+    #   - trips_per_route: number of trips on each route
+    #   - stops_per_trip: number of stops on each trip
+    #   - defects: list of names from synthetic_gtfs.DEFECTS to put into the feeds
+    # Output: pandas dataframe with rows, seconds, peak memory and rows per second of each step for each size
+    results = []
+    folder = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(folder, "gtfs-raw"))
+        os.makedirs(os.path.join(folder, "gtfs-clean"))
+        for n_routes in sizes:
+            path = os.path.join(folder, "gtfs-raw", "feed{}.zip".format(n_routes))
+            rows = make_feed(path, n_routes=n_routes, trips_per_route=trips_per_route, stops_per_trip=stops_per_trip,
+                             n_stops=max(2 * stops_per_trip, n_routes * 5), defects=defects)
+            with zipfile.ZipFile(path) as archive:
+                tables = {name: read_gtfs_table(archive.open(name)) for name in archive.namelist()}
+            stop_times = tables["stop_times.txt"]
+            _, st_dset, stops_dset = cg.check_stop_ids(tables["stops.txt"], stop_times)
+            stop_times = cg.fix_stop_ids(stops_dset, st_dset) if st_dset is not None else stop_times
+            _, interp_dset = cg.check_stop_times(stop_times)
+            steps = [
+                ("read_gtfs_table", len(stop_times.index),
+                 lambda: read_gtfs_table(zipfile.ZipFile(path).open("stop_times.txt")), lambda: ()),
+                ("check_stop_ids", len(stop_times.index), cg.check_stop_ids,
+                 lambda: (tables["stops.txt"], tables["stop_times.txt"])),
+                ("fix_stop_ids", len(stop_times.index), cg.fix_stop_ids,
+                 lambda: (tables["stop_times.txt"].copy(), tables["stops.txt"])),
+                ("check_stop_times", len(stop_times.index), cg.check_stop_times, lambda: (stop_times,)),
+                ("interp_stop_times", len(stop_times.index), cg.interp_stop_times, lambda: (interp_dset.copy(),)),
+                ("check_trips", len(tables["trips.txt"].index), cg.check_trips,
+                 lambda: (tables["trips.txt"], tables["routes.txt"])),
+                ("fix_trips", len(tables["trips.txt"].index), cg.fix_trips,
+                 lambda: (tables["trips.txt"].copy(), tables["routes.txt"].copy())),
+                ("check_transfers", len(tables["transfers.txt"].index), cg.check_transfers,
+                 lambda: (tables["transfers.txt"],)),
+                ("check_routes", len(tables["routes.txt"].index), cg.check_routes, lambda: (tables["routes.txt"],)),
+                ("check_caldates", len(tables["calendar_dates.txt"].index), cg.check_caldates,
+                 lambda: (tables["calendar_dates.txt"],)),
+                ("clean_zipfile", sum(rows.values()),
+                 lambda: cg.clean_zipfile(path, 0, log=lambda message: None)[0].close(), lambda: ()),
+            ]
+            for step, n_rows, func, setup in steps:
+                if step == "interp_stop_times" and interp_dset is None:
+                    continue  # Nothing to interpolate without the blank_final_times defect
+                elapsed, peak = _measure(func, setup)
+                results.append({"step": step, "routes": n_routes, "rows": n_rows, "seconds": round(elapsed, 4),
+                                "peak_mb": round(peak, 1), "rows_per_second": int(n_rows / max(elapsed, 1e-9))})
+    finally:
+        shutil.rmtree(folder)
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    print()
+    print("read_gtfs_table")
+    print(bench_read_table().to_string(index=False))
+    print()
+    print("interp_stop_times")
+    print(bench_interp_stop_times().to_string(index=False))
+    print()
+    print("checks and fixes on synthetic feeds with every defect")
+    print(bench_checks().to_string(index=False))
@@ -1,271 +1,521 @@
 # Correct all GTFS feeds
 
+import argparse
+import collections
+import datetime
 import json
 import shutil
-import datetime as dt
+import sys
+import tempfile
+import traceback
 import zipfile
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 import os
 import numpy as np
+from gtfs_columns import columns_folder, columns_up_to_date, write_feed_columns
+from gtfs_frequencies import compress_frequencies
+from gtfs_profile import SamplingProfiler, StepStats, summary_table, top_functions, write_folded, write_report
+from gtfs_prune import (PRUNED_TABLES, active_services, cascade_removals, minimal_calendar, read_bounds,
+                        stops_in_bounds, trim_stop_times)
+from gtfs_tables import file_sha256, iter_gtfs_table, read_gtfs_table, write_gtfs_table
 
 # Set defaults
 #os.mkdir("data/gtfs-clean")
-agency_count = 0
 pd.options.mode.chained_assignment = None  # Turn off set with copy warnings
+CLEANER_VERSION = 2  # Increase when a check or fix changes, so cached feeds are cleaned again
+PARSE_OVERHEAD = 50  # Approximate peak bytes of memory per byte of csv text while stop_times.txt is parsed and fixed
 
 
 # Check GTFS files for errors and fix them
 
 
-def unzip_to_file(zfile, bpath, full_path, stop_dataset=None, transfer_dataset=None, agency_dataset=None, trips_dataset=None, caldate_dataset=None, routes_dataset=None, st_dataset=None, pathways_dataset=None):
-    # Description: Unzips a zip file to folder, flattens file format, and zips back up
-    #   Optional arguments to remove lines from file that cause errors
-    # Modified from https://stackoverflow.com/questions/4917284/extract-files-from-zip-without-keeping-the-structure-using-python-zipfile
-    # Input:
-    #   - zfile: a zipfile archive
-    #   - bpath: base path to unzip files
-    #   - full_path: full path to zip archive
-    #   - stop_dataset: pandas dataframe of the stop_times.txt stop_dataset
-    #   - transfer_dataset: pandas dataframe of the transfers.txt dataset
-    #   - agency_dataset: pandas dataframe of the agency.txt dataset
-    #   - trips_dataset: pandas dataframe of the trips.txt dataset
-    #   - caldate_dataset: pandas dataframe of the calendar_dates.txt dataset
-    #   - routes_dataset: pandas dataframe of the routes.txt dataset
-    #   - st_dataset: pandas dataframe of the stops.txt dataset
-    # Output: None
-    global agency_count
-    all_names = []
-    for member in zfile.namelist():
+def open_feed(path, log=print):
+    # Description: Opens a GTFS zipfile and maps each GTFS file name to its member in the archive
+    #     Resolves a zip in a zip, and files placed in a subfolder, without extracting anything
+    # Input: path to zipfile, relative or absolute, and a function that records progress messages
+    # Output: zipfile archive, dict of file name to member name, and list of layout fixes, empty if the layout is fine
+    archive = zipfile.ZipFile(path)
+    layout_fixes = []
+    # Check for error where it is a zipfile in a zipfile, and open the inner archive from memory
+    if archive.namelist()[0].split('.')[-1] == 'zip':
+        log("  Fixing zipfile in a zipfile")
+        archive = zipfile.ZipFile(BytesIO(archive.read(archive.namelist()[0])))
+        layout_fixes.append("nested_zip")
+    members = {}
+    for member in archive.namelist():
         filename = os.path.basename(member)
         # skip directories
         if not filename:
             continue
-        # copy or correct file (taken from zipfile's extract)
-        source = zfile.open(member)
-        if filename == "stop_times.txt" and stop_dataset is not None and st_dataset is None:  # interpolate stop times
-            interp_stop_times(stop_dataset, filename)
-        elif filename == "stop_times.txt" and stop_dataset is not None and st_dataset is not None:  # Remove invalid stop_id from stop_times.txt
-            all_stop_ids = st_dataset["stop_id"].unique().tolist()
-            stop_dataset = stop_dataset.loc[stop_dataset["stop_id"].isin(all_stop_ids)]
-            stop_dataset.to_csv('stop_times.txt', index=False)
-        elif filename == "transfers.txt" and transfer_dataset is not None:  # set transfer_type to 0 for missings
-            transfer_dataset["transfer_type"].loc[transfer_dataset["transfer_type"].isnull()] = 0
-            transfer_dataset["transfer_type"] = transfer_dataset["transfer_type"].astype(int)
-            transfer_dataset.to_csv('transfers.txt', index=False)
-        elif filename == "agency.txt" and agency_dataset is not None:  # fix missing fields in agency.txt
-            agency_dataset["agency_timezone"].loc[agency_dataset["agency_timezone"].isnull()] = 'America/Chicago'
-            agency_dataset["agency_url"].loc[agency_dataset["agency_url"].isnull()] = "https://developers.google.com/transit/gtfs/reference/"
-            agency_dataset["agency_name"].loc[agency_dataset["agency_name"].isnull()] = "Agency{}".format(agency_count)
-            agency_count += 1
-            agency_dataset.to_csv('agency.txt', index=False)
-        elif filename == "trips.txt" and trips_dataset is not None and routes_dataset is not None:  # fix duplicates in trips.txt, Add route_ids not in routes.txt file
-            trips_dataset = trips_dataset.drop_duplicates('trip_id')
-            route_ids = routes_dataset["route_id"].values.tolist()
-            trips_dataset_un = trips_dataset["route_id"].loc[~trips_dataset["route_id"].isin(route_ids)].unique()
-            route_type = routes_dataset["route_type"].mode().tolist()[0]  # All new routes will have the same type as the most common route
-            routes_cols = []
-            if "route_short_name" in routes_dataset.columns:
-                routes_cols.append("route_short_name")
-            if "route_long_name" in routes_dataset.columns:
-                routes_cols.append("route_long_name")
-            if "agency_id" in routes_dataset.columns:
-                agency_id = routes_dataset["agency_id"].mode().tolist()[0]
-            store_data = []
-            for k in range(len(trips_dataset_un)):
-                temp = {"route_id": trips_dataset_un[k], "route_type": route_type}
-                for l in range(len(routes_cols)):
-                    temp[routes_cols[l]] = "{}{}".format(routes_cols[l], k)
-                if "agency_id" in routes_dataset.columns:
-                    temp["agency_id"] = agency_id
-                store_data.append(temp)
-            routes_dataset = routes_dataset.append(pd.DataFrame(store_data), ignore_index=True, sort=True)
-            routes_dataset.to_csv('routes.txt', index=False)
-            trips_dataset.to_csv('trips.txt', index=False)
-        elif filename == "routes.txt" and trips_dataset is not None and routes_dataset is not None:  # We've already written out routes.txt, so don't overwrite
-            pass
-        elif filename == "calendar_dates.txt" and caldate_dataset is not None:  # fix non-allowed date in calendar dates
-            caldate_dataset["date"] = caldate_dataset["date"].astype(int)
-            caldate_dataset = caldate_dataset.loc[caldate_dataset["date"] > 10000]
-            caldate_dataset.to_csv('calendar_dates.txt', index=False)
-        elif filename == "routes.txt" and routes_dataset is not None:  # Fix duplicates in routes.txt
-            routes_dataset = routes_dataset.drop_duplicates('route_id')
-            routes_dataset.to_csv('routes.txt', index=False)
-        elif filename == "pathways.txt" and pathways_dataset is not None:
-            path_type, pathways_dataset_clean = fix_pathways(pathways_dataset)
-            if path_type:
-                pathways_dataset_clean.to_csv('pathways.txt', index=False)
-        else:  # If we're not replacing lines, just copy the file directly
-            with open(filename, "wb") as target:
-                shutil.copyfileobj(source, target)
-        all_names.append(filename)
-    with zipfile.ZipFile(full_path, "w", zipfile.ZIP_DEFLATED) as zip_out:
-        for member in all_names:
-            zip_out.write(member)
-    for member in all_names:
-        os.remove(member)
-
-
-def clean_zipfile(path):
-    # Description: For zipfiles that do not have txt files in the root, fix them
-    #     Errors include a zip in a zip, and a zipped up folder
-    # Input: path to zipfile, relative or absolute
-    # Output: zipfile archive
-    shutil.copyfile(path, path.replace('gtfs-raw', 'gtfs-clean'))
-    path = path.replace('gtfs-raw', 'gtfs-clean')
-    archive = zipfile.ZipFile(path)
-    path0 = "/".join(path.split('/')[:-1])
-    # Check for error where it is a zipfile in a zipfile, and unzip it
-    if archive.namelist()[0].split('.')[-1] == 'zip':
-        print("  Fixing zipfile in a zipfile")
-        zfiledata = BytesIO(archive.read(archive.namelist()[0]))
-        archive = zipfile.ZipFile(zfiledata)
-        unzip_to_file(archive, path0, path)
+        members[filename] = member
     # Resolve where agency puts files in a subfolder
-    is_subdir = False
-    if 'stops.txt' not in archive.namelist():
-        for i in archive.namelist():
-            if 'stops.txt' in i:
-                is_subdir = True
-                break
-    if is_subdir:
-        print("  Fixing files placed in a subfolder")
-        unzip_to_file(archive, path0, path)
-    # Remove invalid stop_ids from stop_times.txt
-    archive = zipfile.ZipFile(path)
-    st_data = archive.open('stops.txt')
-    stops_data = archive.open('stop_times.txt')
-    check_st, st_dset, stops_dset = check_stop_ids(st_data, stops_data)
-    if check_st:
-        print("  Removing invalid stop ids from stop_times.txt")
-        unzip_to_file(archive, path0, path, stop_dataset=stops_dset, st_dataset=st_dset)
-    st_data.close()
-    stops_data.close()
-    # Fix error that occurs rarely in stop_times.txt, no stop time for final stop
-    archive = zipfile.ZipFile(path)
-    stop_times_data = archive.open('stop_times.txt')
-    check_st, st_dset = check_stop_times(stop_times_data)
-    if check_st:
-        print("  Interpolating stop times with no final stop time")
-        unzip_to_file(archive, path0, path, stop_dataset=st_dset)
-    stop_times_data.close()
+    if 'stops.txt' not in archive.namelist() and 'stops.txt' in members:
+        log("  Fixing files placed in a subfolder")
+        layout_fixes.append("subfolder")
+    return archive, members, layout_fixes
+
+
+def read_table(archive, members, tables, filename, stats):
+    # Description: Parses a GTFS file from the archive the first time it is needed, and caches it
+    # Input:
+    #   - archive: zipfile archive
+    #   - members: dict of file name to member name
+    #   - tables: dict of file name to pandas dataframe, already parsed files
+    #   - filename: name of the GTFS file, e.g. stop_times.txt
+    #   - stats: StepStats that records the read
+    # Output: pandas dataframe, or None if the file is not in the feed
+    if filename not in tables:
+        if filename not in members:
+            return None
+        info = archive.getinfo(members[filename])
+        with stats.step("read " + filename, bytes_read=info.file_size) as record:
+            with archive.open(members[filename]) as source:
+                tables[filename] = read_gtfs_table(source)
+            record["rows_read"] = len(tables[filename].index)
+    return tables[filename]
+
+
+def write_feed(archive, members, tables, modified, full_path, streamed=None):
+    # Description: Writes the cleaned feed in a single pass, flattening the file layout
+    #     Corrected tables are serialized straight into the output archive, all other files are streamed from the source
+    # Input:
+    #   - archive: zipfile archive
+    #   - members: dict of file name to member name
+    #   - tables: dict of file name to pandas dataframe
+    #   - modified: set of file names that were corrected
+    #   - full_path: full path to output zip archive
+    #   - streamed: dict of file name to open temporary file holding a table corrected in chunks, or None
+    #     Modified files that are not in the source archive, e.g. calendar_dates.txt for a pruned calendar, are added
+    # Output: None
+    streamed = streamed or {}
+    with zipfile.ZipFile(full_path, "w", zipfile.ZIP_DEFLATED) as zip_out:
+        for filename, member in members.items():
+            with zip_out.open(filename, "w") as target:
+                if filename in modified and filename in streamed:
+                    streamed[filename].seek(0)
+                    shutil.copyfileobj(streamed[filename], target)
+                elif filename in modified:
+                    write_gtfs_table(tables[filename], target)
+                else:  # If we're not replacing lines, just copy the file directly
+                    with archive.open(member) as source:
+                        shutil.copyfileobj(source, target)
+        for filename in sorted(set(modified) - set(members)):
+            with zip_out.open(filename, "w") as target:
+                write_gtfs_table(tables[filename], target)
+
+
+def stop_times_chunksize(archive, member, max_memory):
+    # Description: Decides whether stop_times.txt has to be processed in chunks to stay under the memory ceiling
+    # Input: zipfile archive, member name of stop_times.txt, and memory ceiling in bytes or None
+    # Output: number of rows per chunk, or None to load the whole file
+    info = archive.getinfo(member)
+    if max_memory is None or info.file_size * PARSE_OVERHEAD <= max_memory:
+        return None
+    with archive.open(member) as source:
+        sample = source.read(1 << 16)
+    line_bytes = len(sample) / max(sample.count(b'\n'), 1)
+    return max(1000, int(max_memory / (PARSE_OVERHEAD * line_bytes)))
+
+
+def stream_stop_times(archive, member, stops, target, chunksize, log=print, stats=None, service_trips=None,
+                      keep_stops=None, kept_trips=None):
+    # Description: Removes invalid stop ids and interpolates missing final stop times in stop_times.txt, in chunks
+    #     Chunks never split a trip, so each chunk gets the same fixes as the whole file would, and trips can be
+    #     cut down to the stops of the study area chunk by chunk. The corrected table is written to target chunk by chunk
+    # Input:
+    #   - archive: zipfile archive
+    #   - member: member name of stop_times.txt
+    #   - stops: pandas dataframe of stops.txt
+    #   - target: open temporary file, in binary mode
+    #   - chunksize: number of rows per chunk
+    #   - log: function that records progress messages
+    #   - stats: StepStats that records the pass over the file, or None to not keep the record
+    #   - service_trips: array of the trip_ids that run on the analysis dates, or None to keep every trip
+    #   - keep_stops: array of the stop_ids inside the study area, or None to not prune the trips
+    #   - kept_trips: set that collects the trip_ids left in the file when pruning, or None
+    # Output: list of the fixes that were applied, or None if the file is not ordered by trip or every stop id is
+    #     invalid, in which case the whole file has to be checked at once
+    if stats is None:
+        stats = StepStats()
+    all_stop_ids = stops["stop_id"].unique().tolist()
+    fixes = []
+    seen = set()
+    n_rows = 0
+    n_checked = 0
+    n_invalid = 0
+    with stats.step("stream_stop_times", bytes_read=archive.getinfo(member).file_size) as record, \
+            archive.open(member) as source:
+        record["rows_modified"] = 0
+        for i, chunk in enumerate(iter_gtfs_table(source, chunksize, group_by="trip_id")):
+            trip_ids = set(chunk["trip_id"].dropna().unique())
+            if not seen.isdisjoint(trip_ids):
+                return None
+            seen.update(trip_ids)
+            n_rows += len(chunk.index)
+            record["rows_read"] = n_rows
+            if service_trips is not None:
+                running = chunk["trip_id"].isin(service_trips)
+                if not running.all():
+                    record["rows_modified"] += int((~running).sum())
+                    chunk = chunk.loc[running.values]
+                    if "prune_dates" not in fixes:
+                        fixes.append("prune_dates")
+            n_checked += len(chunk.index)
+            valid = chunk["stop_id"].isin(all_stop_ids)
+            if not valid.all():
+                n_invalid += int((~valid).sum())
+                record["rows_modified"] += int((~valid).sum())
+                chunk = chunk.loc[valid]
+                if "stop_ids" not in fixes:
+                    fixes.append("stop_ids")
+            check_st, st_dset = check_stop_times(chunk)
+            if check_st:
+                record["rows_modified"] += int(st_dset["missing"].sum())
+                chunk = interp_stop_times(st_dset)
+                if "final_stop_times" not in fixes:
+                    fixes.append("final_stop_times")
+            if keep_stops is not None:
+                trimmed = trim_stop_times(chunk, keep_stops)
+                if len(trimmed.index) < len(chunk.index):
+                    record["rows_modified"] += len(chunk.index) - len(trimmed.index)
+                    chunk = trimmed
+                    if "prune" not in fixes:
+                        fixes.append("prune")
+                if kept_trips is not None:
+                    kept_trips.update(chunk["trip_id"].dropna().unique())
+            write_gtfs_table(chunk, target, header=(i == 0))
+        record["bytes_written"] = target.tell()
+    if n_checked > 0 and n_invalid == n_checked:  # Ignores those where datatypes differ between stops.txt and stop_times.txt
+        return None
+    if "stop_ids" in fixes:
+        log("  Removing invalid stop ids from stop_times.txt")
+    if "final_stop_times" in fixes:
+        log("  Interpolating stop times with no final stop time")
+    return fixes
+
+
+def clean_zipfile(path, agency_index=0, log=print, max_memory=None, stats=None, bounds=None, dates=None,
+                  frequency_tolerance=None):
+    # Description: Checks a GTFS zipfile for errors and writes a corrected copy to gtfs-clean
+    #     Each file is read from the archive at most once, all fixes are applied in memory,
+    #     and the output archive is written once. If stop_times.txt is too large for the memory ceiling,
+    #     it is checked and corrected in chunks instead. If bounds are given, the feed is then pruned to the stops
+    #     inside them, and to the trips, routes, shapes and services that still use those stops. If dates are given,
+    #     the trips that do not run on any of them are dropped before stop_times.txt is checked, and the calendar
+    #     is rewritten to run the remaining services on those dates only. If a frequency tolerance is given, trips
+    #     that repeat at an even headway are finally replaced by frequencies.txt
+    # Input:
+    #   - path: path to zipfile, relative or absolute
+    #   - agency_index: number used for the placeholder name of an agency with no name
+    #   - log: function that records progress messages
+    #   - max_memory: memory ceiling for reading stop_times.txt in bytes, or None for no ceiling
+    #   - stats: StepStats that records each read, check, fix and write, or None to not keep the records
+    #   - bounds: list of south, west, north and east edges in degrees from read_bounds, or None to not prune
+    #   - dates: list of datetime.date that routing is run on, or None to keep the service of every date
+    #   - frequency_tolerance: seconds that generated stop times may differ from the trips they replace,
+    #     or None to not use frequencies.txt
+    # Output: zipfile archive, and list of the fixes that were applied
+    out_path = path.replace('gtfs-raw', 'gtfs-clean')
+    out_dir = os.path.dirname(out_path) or '.'
+    if stats is None:
+        stats = StepStats()
+    stats.feed = os.path.basename(path)
+    with stats.step("open_feed", bytes_read=os.path.getsize(path)):
+        archive, members, fixes = open_feed(path, log)
+    flatten = len(fixes) > 0
+    tables = {}
+    modified = set()
+    streamed = {}
+    # Fix rare error where calendar_dates.txt date field takes a value that is not YYYYMMDD
+    if 'calendar_dates.txt' in members:  # calendar_dates.txt is optional, and does not have to appear in all GTFS feeds
+        caldates = read_table(archive, members, tables, 'calendar_dates.txt', stats)
+        with stats.step("check_caldates", rows_read=len(caldates.index)):
+            check_cal, cal_dset = check_caldates(caldates)
+        if check_cal:
+            log("  Fixing calendar dates file")
+            fixes.append("calendar_dates")
+            with stats.step("fix_caldates", rows_read=len(cal_dset.index)) as record:
+                tables['calendar_dates.txt'] = fix_caldates(cal_dset)
+                record["rows_modified"] = len(cal_dset.index) - len(tables['calendar_dates.txt'].index)
+            modified.add('calendar_dates.txt')
+    # Find the trips that run on the analysis dates, from the corrected calendar_dates.txt
+    keep_stops, kept_trips, service_trips = None, None, None
+    if dates is not None:
+        calendar = read_table(archive, members, tables, 'calendar.txt', stats)
+        trips = read_table(archive, members, tables, 'trips.txt', stats)
+        with stats.step("prune_services", rows_read=len(trips.index)) as record:
+            active = active_services(calendar, tables.get('calendar_dates.txt'), dates)
+            running = trips["service_id"].astype(object).isin(active["service_id"]).values
+            service_trips = trips.loc[running, "trip_id"].dropna().astype(object).unique()
+            record["rows_modified"] = int((~running).sum())
+    if bounds is not None:
+        stops = read_table(archive, members, tables, 'stops.txt', stats)
+        with stats.step("prune_stops", rows_read=len(stops.index)) as record:
+            inside = stops_in_bounds(stops, bounds)
+            keep_stops = stops["stop_id"].dropna().astype(object).values[inside[stops["stop_id"].notnull().values]]
+            record["rows_modified"] = int((~inside).sum())
+    chunksize = stop_times_chunksize(archive, members['stop_times.txt'], max_memory)
+    if chunksize is not None:
+        # Remove invalid stop_ids and interpolate missing final stop times, one group of trips at a time
+        streamed['stop_times.txt'] = tempfile.TemporaryFile(dir=out_dir)
+        stops = read_table(archive, members, tables, 'stops.txt', stats)
+        kept_trips = set() if bounds is not None else None
+        st_fixes = stream_stop_times(archive, members['stop_times.txt'], stops, streamed['stop_times.txt'], chunksize,
+                                     log, stats, service_trips, keep_stops, kept_trips)
+        if st_fixes is None:
+            log("  stop_times.txt is not ordered by trip, reading it at once")
+            streamed.pop('stop_times.txt').close()
+            kept_trips = None
+        elif st_fixes:
+            fixes.extend(st_fixes)
+            modified.add('stop_times.txt')
+    if 'stop_times.txt' not in streamed:
+        # Remove invalid stop_ids from stop_times.txt
+        stops = read_table(archive, members, tables, 'stops.txt', stats)
+        stimes = read_table(archive, members, tables, 'stop_times.txt', stats)
+        if service_trips is not None:
+            # Drop the stop times of trips that do not run on the analysis dates, before they are checked
+            with stats.step("prune_trips", rows_read=len(stimes.index)) as record:
+                running = stimes["trip_id"].isin(service_trips).values
+                record["rows_modified"] = int((~running).sum())
+            if not running.all():
+                stimes = tables['stop_times.txt'] = stimes.loc[running]
+                fixes.append("prune_dates")
+                modified.add('stop_times.txt')
+        with stats.step("check_stop_ids", rows_read=len(stimes.index)):
+            check_st, st_dset, stops_dset = check_stop_ids(stops, stimes)
+        if check_st:
+            log("  Removing invalid stop ids from stop_times.txt")
+            fixes.append("stop_ids")
+            with stats.step("fix_stop_ids", rows_read=len(stops_dset.index)) as record:
+                tables['stop_times.txt'] = fix_stop_ids(stops_dset, st_dset)
+                record["rows_modified"] = len(stops_dset.index) - len(tables['stop_times.txt'].index)
+            modified.add('stop_times.txt')
+        # Fix error that occurs rarely in stop_times.txt, no stop time for final stop
+        with stats.step("check_stop_times", rows_read=len(tables['stop_times.txt'].index)):
+            check_st, st_dset = check_stop_times(tables['stop_times.txt'])
+        if check_st:
+            log("  Interpolating stop times with no final stop time")
+            fixes.append("final_stop_times")
+            with stats.step("interp_stop_times", rows_read=len(st_dset.index),
+                            rows_modified=int(st_dset["missing"].sum())):
+                tables['stop_times.txt'] = interp_stop_times(st_dset)
+            modified.add('stop_times.txt')
     # Fix error that occurs rarely in transfers.txt, where values for transfer_type are missing
-    archive = zipfile.ZipFile(path)
-    if 'transfers.txt' in archive.namelist():  # transfers.txt is optional, and does not have to appear in all GTFS feeds
-        transfer_data = archive.open('transfers.txt')
-        check_tr, tr_dset = check_transfers(transfer_data)
+    if 'transfers.txt' in members:  # transfers.txt is optional, and does not have to appear in all GTFS feeds
+        transfers = read_table(archive, members, tables, 'transfers.txt', stats)
+        with stats.step("check_transfers", rows_read=len(transfers.index)):
+            check_tr, tr_dset = check_transfers(transfers)
         if check_tr:
-            print("  Fixing transfer type field in transfers")
-            unzip_to_file(archive, path0, path, transfer_dataset=tr_dset)
-        transfer_data.close()
+            log("  Fixing transfer type field in transfers")
+            fixes.append("transfers")
+            with stats.step("fix_transfers", rows_read=len(tr_dset.index),
+                            rows_modified=int(tr_dset["transfer_type"].isnull().sum())):
+                tables['transfers.txt'] = fix_transfers(tr_dset)
+            modified.add('transfers.txt')
     # fix error that can occur in pathways.txt where OTP looks for required pathways_type buy file names pathways_mdoe
-    archive = zipfile.ZipFile(path)
-    if 'pathways.txt' in archive.namelist(): #pathways.txt is optional, and does not have to appear in all GTFS feeds
-        pathways_data = archive.open('pathways.txt')
-        paths = pd.read_csv(pathways_data)
-        paths.columns = [x.strip() for x in paths.columns]
-        if "path_type" not in paths.columns:
-            unzip_to_file(archive, path0, path, pathways_dataset=paths)
-        pathways_data.close()
+    if 'pathways.txt' in members:  # pathways.txt is optional, and does not have to appear in all GTFS feeds
+        paths = read_table(archive, members, tables, 'pathways.txt', stats)
+        if "pathway_mode" in paths.columns:
+            with stats.step("fix_pathways", rows_read=len(paths.index), rows_modified=0):  # Only the header changes
+                path_type, tables['pathways.txt'] = fix_pathways(paths)
+            fixes.append("pathways")
+            modified.add('pathways.txt')
     # Fix error that occurs rarely in agency.txt, required fields agency_name,agency_url,agency_timezone missing, extra characters in final line (removed automatically by pandas)
-    archive = zipfile.ZipFile(path)
-    agency_data = archive.open('agency.txt')
-    check_ag, ag_dset = check_agency(agency_data)
+    agency = read_table(archive, members, tables, 'agency.txt', stats)
+    with stats.step("check_agency", rows_read=len(agency.index)):
+        with archive.open(members['agency.txt']) as agency_data:
+            agency_lines = agency_data.read().decode('utf-8-sig').splitlines()
+        check_ag, ag_dset = check_agency(agency, agency_lines)
     if check_ag:
-        print("  Fixing missing fields in agency file")
-        unzip_to_file(archive, path0, path, agency_dataset=ag_dset)
-    agency_data.close()
+        log("  Fixing missing fields in agency file")
+        fixes.append("agency")
+        required = ["agency_name", "agency_url", "agency_timezone"]
+        with stats.step("fix_agency", rows_read=len(ag_dset.index),
+                        rows_modified=int(ag_dset[required].isnull().any(axis=1).sum())):
+            tables['agency.txt'] = fix_agency(ag_dset, agency_index)
+        modified.add('agency.txt')
     # Fix duplicates in trips.txt on trip_id, and fix error where route_id in trips.txt not in routes.txt
-    archive = zipfile.ZipFile(path)
-    trips_data = archive.open('trips.txt')
-    routes_data = archive.open('routes.txt')
-    check_tri, tri_dset, rou_dset = check_trips(trips_data, routes_data)
+    trips = read_table(archive, members, tables, 'trips.txt', stats)
+    routes = read_table(archive, members, tables, 'routes.txt', stats)
+    with stats.step("check_trips", rows_read=len(trips.index) + len(routes.index)):
+        check_tri, tri_dset, rou_dset = check_trips(trips, routes)
     if check_tri:
-        print("  Fixing duplicates, route_ids in trips file")
-        unzip_to_file(archive, path0, path, trips_dataset=tri_dset, routes_dataset=rou_dset)
-    trips_data.close()
-    routes_data.close()
-    # Fix rare error where calendar_dates.txt date field takes a value that is not YYYYMMDD
-    archive = zipfile.ZipFile(path)
-    if 'calendar_dates.txt' in archive.namelist():  # calendar_dates.txt is optional, and does not have to appear in all GTFS feeds
-        caldates_data = archive.open('calendar_dates.txt')
-        check_cal, cal_dset = check_caldates(caldates_data)
-        if check_cal:
-            print("  Fixing calendar dates file")
-            unzip_to_file(archive, path0, path, caldate_dataset=cal_dset)
-        caldates_data.close()
+        log("  Fixing duplicates, route_ids in trips file")
+        fixes.append("trips")
+        with stats.step("fix_trips", rows_read=len(tri_dset.index) + len(rou_dset.index)) as record:
+            tables['trips.txt'], tables['routes.txt'] = fix_trips(tri_dset, rou_dset)
+            # Duplicate trips removed, and routes added
+            record["rows_modified"] = (len(tri_dset.index) - len(tables['trips.txt'].index)
+                                       + len(tables['routes.txt'].index) - len(rou_dset.index))
+        modified.update(['trips.txt', 'routes.txt'])
     # Fix duplicate route ids in routes.txt
-    archive = zipfile.ZipFile(path)
-    routes_data = archive.open('routes.txt')
-    check_rou, rou_dset = check_routes(routes_data)
+    with stats.step("check_routes", rows_read=len(tables['routes.txt'].index)) as record:
+        check_rou, rou_dset = check_routes(tables['routes.txt'])
+        if check_rou:
+            record["rows_modified"] = len(tables['routes.txt'].index) - len(rou_dset.index)
     if check_rou:
-        print("  Fixing duplicate route ids")
-        unzip_to_file(archive, path0, path, routes_dataset=rou_dset)
-    routes_data.close()
-    return zipfile.ZipFile(path)
-
+        log("  Fixing duplicate route ids")
+        fixes.append("routes")
+        tables['routes.txt'] = rou_dset
+        modified.add('routes.txt')
+    # Prune the feed to the study area and the analysis dates, after the fixes so that every trip has its final stop time
+    if bounds is not None or dates is not None:
+        if bounds is not None and 'stop_times.txt' not in streamed:
+            stimes = read_table(archive, members, tables, 'stop_times.txt', stats)
+            with stats.step("prune_stop_times", rows_read=len(stimes.index)) as record:
+                tables['stop_times.txt'] = trim_stop_times(stimes, keep_stops)
+                record["rows_modified"] = len(stimes.index) - len(tables['stop_times.txt'].index)
+            if record["rows_modified"] > 0:
+                fixes.append("prune")
+                modified.add('stop_times.txt')
+            kept_trips = tables['stop_times.txt']["trip_id"].dropna().unique()
+        elif bounds is None:
+            kept_trips = service_trips
+        for filename in PRUNED_TABLES:
+            read_table(archive, members, tables, filename, stats)
+        n_trips, n_stops = len(tables['trips.txt'].index), len(tables['stops.txt'].index)
+        n_rows = sum(len(tables[f].index) for f in PRUNED_TABLES if f in tables)
+        with stats.step("prune_feed", rows_read=n_rows) as record:
+            pruned = cascade_removals(tables, keep_stops, np.array(list(kept_trips), dtype=object))
+            record["rows_modified"] = sum(len(tables[f].index) - len(table.index) for f, table in pruned.items())
+        tables.update(pruned)
+        modified.update(pruned)
+        if bounds is not None and (pruned or "prune" in fixes):
+            log("  Pruning to the study area, {} of {} stops kept".format(len(tables['stops.txt'].index), n_stops))
+            if "prune" not in fixes:
+                fixes.append("prune")
+        if dates is not None:
+            # Run the remaining services on the analysis dates only
+            old_rows = sum(len(tables[f].index) for f in ['calendar.txt', 'calendar_dates.txt'] if f in tables)
+            with stats.step("prune_calendar", rows_read=old_rows) as record:
+                services = tables['trips.txt']["service_id"].astype(object).unique()
+                calendar, caldates = minimal_calendar(active.loc[active["service_id"].isin(services).values],
+                                                      'calendar.txt' in members)
+                new_rows = len(caldates.index) + (0 if calendar is None else len(calendar.index))
+                record["rows_modified"] = old_rows - new_rows
+            if calendar is not None:
+                tables['calendar.txt'] = calendar
+                modified.add('calendar.txt')
+            if 'calendar_dates.txt' in members or len(caldates.index) > 0:
+                tables['calendar_dates.txt'] = caldates
+                modified.add('calendar_dates.txt')
+            log("  Pruning to the service of {}".format(", ".join(date.isoformat() for date in sorted(dates))))
+            if "prune_dates" not in fixes:
+                fixes.append("prune_dates")
+        if "prune" in fixes or "prune_dates" in fixes:
+            log("  {} of {} trips kept".format(len(tables['trips.txt'].index), n_trips))
+    # Replace trips that repeat at an even headway with frequencies.txt, once every fix and pruning is done
+    if frequency_tolerance is not None and 'stop_times.txt' in streamed:
+        log("  stop_times.txt was corrected in chunks, not compressing it into frequencies.txt")
+    elif frequency_tolerance is not None:
+        stimes = read_table(archive, members, tables, 'stop_times.txt', stats)
+        trips = read_table(archive, members, tables, 'trips.txt', stats)
+        frequencies = read_table(archive, members, tables, 'frequencies.txt', stats)
+        transfers = read_table(archive, members, tables, 'transfers.txt', stats)
+        n_frequencies = 0 if frequencies is None else len(frequencies.index)
+        with stats.step("compress_frequencies", rows_read=len(stimes.index) + len(trips.index)) as record:
+            new_stimes, new_trips, new_frequencies, n_removed = compress_frequencies(stimes, trips, frequencies,
+                                                                                    transfers, frequency_tolerance)
+            n_added = 0 if new_frequencies is None else len(new_frequencies.index) - n_frequencies
+            # Rows saved across stop_times.txt, trips.txt and frequencies.txt
+            record["rows_modified"] = len(stimes.index) - len(new_stimes.index) + n_removed - n_added
+        if n_removed > 0:
+            log("  Replacing {} trips with {} frequencies, {} stop times saved".format(
+                n_removed + n_added, n_added, len(stimes.index) - len(new_stimes.index)))
+            fixes.append("frequencies")
+            tables['stop_times.txt'], tables['trips.txt'] = new_stimes, new_trips
+            tables['frequencies.txt'] = new_frequencies
+            modified.update(['stop_times.txt', 'trips.txt', 'frequencies.txt'])
+    # Write the cleaned feed once, or copy it unchanged if nothing needed fixing
+    # The feed is written to its own temporary file and moved into place, so parallel workers never share scratch files
+    fd, tmp_path = tempfile.mkstemp(suffix='.zip.tmp', dir=out_dir)
+    os.close(fd)
+    try:
+        with stats.step("write_feed") as record:
+            if modified or flatten:
+                write_feed(archive, members, tables, modified, tmp_path, streamed)
+            else:
+                shutil.copyfile(path, tmp_path)
+            record["bytes_written"] = os.path.getsize(tmp_path)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        for f in streamed.values():
+            f.close()
+    archive.close()
+    return zipfile.ZipFile(out_path), fixes
 
-def fix_stop_time_file(dframe):
-    # Description: Removes erroneous leading and trailing spaces from pandas file, which occurs very rarely
-    # Input: Python open file
-    # Output: pandas dataframe
-    d_check_file = pd.read_csv(dframe)
-    d_check_file.columns = [x.strip() for x in d_check_file.columns]
-    for k in range(len(d_check_file.columns)):
-        if str(d_check_file.dtypes[k]) == 'object':
-            d_check_file[d_check_file.columns[k]] = [str(x).strip().replace('nan', '') for x in d_check_file[d_check_file.columns[k]]]
-    return d_check_file
 
-
-def check_stop_times(stop_file):
+def check_stop_times(stimes):
     # Description: For zipfiles that have stop_times.txt where the last stop has no time value, check if this is the case, and if so, return the dataset (efficiency)
-    # Input: Python open file
+    #     The last stop of each trip is found with a grouped transform, so the table is only copied if there is an error
+    # Input: Pandas dataframe of stop_times.txt
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    stimes = fix_stop_time_file(stop_file)
-    stimes["arrival_time"].loc[stimes["arrival_time"] == ""] = np.nan
-    stimes["departure_time"].loc[stimes["departure_time"] == ""] = np.nan
-    stimes["arrival_time"].loc[(stimes["arrival_time"].isnull()) & (stimes["departure_time"].notnull())] = stimes["departure_time"].loc[(stimes["arrival_time"].isnull()) & (stimes["departure_time"].notnull())]
-    stimes["departure_time"].loc[(stimes["departure_time"].isnull()) & (stimes["arrival_time"].notnull())] = stimes["arrival_time"].loc[(stimes["departure_time"].isnull()) & (stimes["arrival_time"].notnull())]
-    last_vals = stimes.groupby('trip_id', as_index=False)['stop_sequence'].max()
-    last_vals["last"] = 1
-    stimes_max = stimes.merge(last_vals, how="left", on=["trip_id", "stop_sequence"])
-    stimes_max["missing"] = 0
-    stimes_max["missing"].loc[(stimes_max["last"] == 1) & (stimes_max["arrival_time"].isnull())] = 1
-    if sum(stimes_max["missing"]) > 0:
+    arrival = stimes["arrival_time"].fillna(stimes["departure_time"])
+    last = stimes["stop_sequence"] == stimes.groupby('trip_id', observed=True)['stop_sequence'].transform('max')
+    last = last.fillna(False).astype(bool)
+    missing = last & arrival.isnull()
+    if missing.any():
+        stimes_max = stimes.copy()
+        stimes_max["arrival_time"] = arrival
+        stimes_max["departure_time"] = stimes_max["departure_time"].fillna(arrival)
+        stimes_max["last"] = last.astype(int)
+        stimes_max["missing"] = missing.astype(int)
         return True, stimes_max
     else:
         return False, None
 
 
-def interp_stop_times(sdata, fname):
+def interp_stop_times(sdata):
     # Description: For zipfiles that have stop_times.txt where the last stop has no time value, add interpolated guess
+    #     All trips are filled at once from per-trip summaries, with times handled as seconds past midnight
     # Input:
     #   - sdata: Pandas dataframe of stop_times.txt file with missings marked
-    #   - fname: Full path of the file, for writing data out
-    # Output: None, writes data out to file
-    def_time = 5  # 5 minutes between stops if there's only one time
-    def_time_amt = 8  # Default time is 8 am for first stop if all stop times are blank
-    missing_ids = sdata["trip_id"].loc[sdata["missing"] == 1]
-    sdata_missing = sdata.loc[sdata["trip_id"].isin(missing_ids)]
-    for id in missing_ids:
-        cur_id = sdata_missing.loc[sdata_missing["trip_id"] == id]
-        exist_id = cur_id.loc[cur_id["arrival_time"].notnull()]
-        max_cur = cur_id["stop_sequence"].values[-1]
-        if len(exist_id.index) == 0:
-            mval = str(dt.timedelta(hours=def_time_amt) + dt.timedelta(minutes=def_time * len(cur_id.index)))
-        elif len(exist_id.index) == 1:
-            where_n = exist_id["arrival_time"].values[0]
-            where_max = exist_id["stop_sequence"].values[0]
-            mval = str(pd.to_timedelta(where_n) + dt.timedelta(minutes=def_time * (len(cur_id.index) - int(where_max)))).split("days ")[-1]
-        else:
-            def_time_int = (pd.to_timedelta(exist_id["arrival_time"].values[-1]) - pd.to_timedelta(exist_id["arrival_time"].values[-2])).seconds/60
-            t_distance = int(exist_id["stop_sequence"].values[-1] - exist_id["stop_sequence"].values[-2])
-            def_time = def_time_int / t_distance
-            nvals = len(cur_id.index) - int(exist_id["stop_sequence"].values[-1])
-            mval = str(pd.to_timedelta(exist_id["arrival_time"].values[-1]) + dt.timedelta(minutes=int(def_time * nvals))).split("days ")[-1]
-        sdata["arrival_time"].loc[(sdata["stop_sequence"] == max_cur) & (sdata["trip_id"] == id)] = mval
-        sdata["departure_time"].loc[(sdata["stop_sequence"] == max_cur) & (sdata["trip_id"] == id)] = mval
-    sdata.to_csv(fname, index=False)
+    # Output: Pandas dataframe of stop_times.txt with final stop times filled in
+    def_time = 5 * 60  # 5 minutes between stops if there's only one time
+    def_time_amt = 8 * 3600  # Default time is 8 am for first stop if all stop times are blank
+    missing_rows = sdata.loc[sdata["missing"] == 1]
+    cur = sdata.loc[sdata["trip_id"].isin(missing_rows["trip_id"]), ["trip_id", "stop_sequence"]]
+    cur["seconds"] = sdata.loc[cur.index, "arrival_time"].astype(float)
+    trip_ids = pd.Index(missing_rows["trip_id"])
+    n_stops = cur.groupby("trip_id", observed=True).size().reindex(trip_ids).values
+    # Last two known times in each trip
+    exist = cur.loc[cur["seconds"].notnull()]
+    from_end = exist.groupby("trip_id", observed=True).cumcount(ascending=False)
+    last = exist.loc[from_end == 0].set_index("trip_id").reindex(trip_ids)
+    prev = exist.loc[from_end == 1].set_index("trip_id").reindex(trip_ids)
+    last_seq = last["stop_sequence"].astype(float).values
+    last_time = last["seconds"].values
+    # No known times: default start time plus default time for each stop
+    mval = def_time_amt + def_time * n_stops
+    # One known time: default time for each stop after the known one
+    one_known = ~np.isnan(last_time) & np.isnan(prev["seconds"].values)
+    mval = np.where(one_known, last_time + def_time * (n_stops - last_seq), mval)
+    # Two or more known times: extrapolate the pace between the last two known times, in whole minutes
+    two_known = ~np.isnan(prev["seconds"].values)
+    t_distance = last_seq - prev["stop_sequence"].astype(float).values
+    t_distance[~two_known | (t_distance == 0)] = 1
+    def_time_int = (last_time - prev["seconds"].values) % 86400 / 60
+    nvals = n_stops - last_seq
+    mval = np.where(two_known, last_time + 60 * np.trunc(def_time_int / t_distance * nvals), mval)
+    sdata.loc[missing_rows.index, "arrival_time"] = mval
+    sdata.loc[missing_rows.index, "departure_time"] = mval
+    return sdata.drop(columns=["last", "missing"])
+
+
+def fix_stop_ids(stop_dataset, st_dataset):
+    # Description: Removes stop_times.txt rows whose stop_id is not in stops.txt
+    # Input:
+    #   - stop_dataset: pandas dataframe of the stop_times.txt dataset
+    #   - st_dataset: pandas dataframe of the stops.txt dataset
+    # Output: pandas dataframe of stop_times.txt
+    all_stop_ids = st_dataset["stop_id"].unique().tolist()
+    return stop_dataset.loc[stop_dataset["stop_id"].isin(all_stop_ids)]
+
 
 def fix_pathways(paths):
     if "pathway_mode" in paths.columns:
@@ -276,11 +526,69 @@ def fix_pathways(paths):
     else:
         return False, None
 
-def check_transfers(trans_data):
+
+def fix_transfers(transfer_dataset):
+    # Description: Sets transfer_type to 0 for missings
+    # Input: pandas dataframe of the transfers.txt dataset
+    # Output: pandas dataframe of transfers.txt
+    transfer_dataset.loc[transfer_dataset["transfer_type"].isnull(), "transfer_type"] = 0
+    transfer_dataset["transfer_type"] = transfer_dataset["transfer_type"].astype(int)
+    return transfer_dataset
+
+
+def fix_agency(agency_dataset, agency_index):
+    # Description: Fills missing required fields in agency.txt
+    # Input:
+    #   - agency_dataset: pandas dataframe of the agency.txt dataset
+    #   - agency_index: number used for the placeholder agency name, the position of the feed in the sorted list of feeds
+    # Output: pandas dataframe of agency.txt
+    agency_dataset.loc[agency_dataset["agency_timezone"].isnull(), "agency_timezone"] = 'America/Chicago'
+    agency_dataset.loc[agency_dataset["agency_url"].isnull(), "agency_url"] = "https://developers.google.com/transit/gtfs/reference/"
+    agency_dataset.loc[agency_dataset["agency_name"].isnull(), "agency_name"] = "Agency{}".format(agency_index)
+    return agency_dataset
+
+
+def fix_trips(trips_dataset, routes_dataset):
+    # Description: Removes duplicates in trips.txt, and adds route_ids not in routes.txt to routes.txt
+    # Input:
+    #   - trips_dataset: pandas dataframe of the trips.txt dataset
+    #   - routes_dataset: pandas dataframe of the routes.txt dataset
+    # Output: pandas dataframes of trips.txt and routes.txt
+    trips_dataset = trips_dataset.drop_duplicates('trip_id')
+    route_ids = routes_dataset["route_id"].values.tolist()
+    trips_dataset_un = trips_dataset["route_id"].loc[~trips_dataset["route_id"].isin(route_ids)].unique()
+    route_type = routes_dataset["route_type"].mode().tolist()[0]  # All new routes will have the same type as the most common route
+    routes_cols = []
+    if "route_short_name" in routes_dataset.columns:
+        routes_cols.append("route_short_name")
+    if "route_long_name" in routes_dataset.columns:
+        routes_cols.append("route_long_name")
+    if "agency_id" in routes_dataset.columns:
+        agency_id = routes_dataset["agency_id"].mode().tolist()[0]
+    store_data = []
+    for k in range(len(trips_dataset_un)):
+        temp = {"route_id": trips_dataset_un[k], "route_type": route_type}
+        for l in range(len(routes_cols)):
+            temp[routes_cols[l]] = "{}{}".format(routes_cols[l], k)
+        if "agency_id" in routes_dataset.columns:
+            temp["agency_id"] = agency_id
+        store_data.append(temp)
+    routes_dataset = pd.concat([routes_dataset, pd.DataFrame(store_data)], ignore_index=True, sort=True)
+    return trips_dataset, routes_dataset
+
+
+def fix_caldates(caldate_dataset):
+    # Description: Removes non-allowed dates in calendar_dates.txt
+    # Input: pandas dataframe of the calendar_dates.txt dataset
+    # Output: pandas dataframe of calendar_dates.txt
+    caldate_dataset["date"] = caldate_dataset["date"].astype(int)
+    return caldate_dataset.loc[caldate_dataset["date"] > 10000]
+
+
+def check_transfers(ttimes):
     # Description: For transfer files that do not have values for transfer_type, add a default value of 0
-    # Input: Python open file
+    # Input: Pandas dataframe of transfers.txt
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    ttimes = pd.read_csv(trans_data)
     ttimes_missing = ttimes.loc[ttimes["transfer_type"].isnull()]
     if len(ttimes_missing.index) > 0:
         return True, ttimes
@@ -288,29 +596,25 @@ def check_transfers(trans_data):
         return False, None
 
 
-def check_agency(agen_data):
+def check_agency(atimes, agen_lines):
     # Description: For agency files that have required values missing, check for that
-    # Input: Python open file
+    # Input: Pandas dataframe of agency.txt, and the raw lines of agency.txt
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    atimes = pd.read_csv(agen_data)
-    atimes.columns = [x.strip() for x in atimes.columns]
     req_fields = ["agency_name", "agency_url", "agency_timezone"]
     for req in req_fields:
         if len(atimes.loc[atimes[req].isnull()].index) > 0:
             return True, atimes
-    all_lines = [len(str(x).split(',')) for x in agen_data]
+    all_lines = [len(str(x).split(',')) for x in agen_lines]
     if len(set(all_lines)) > 1:
         return True, atimes
     else:
         return False, None
 
 
-def check_trips(tri_data, rou_data):
+def check_trips(tritimes, route_data):
     # Description: For trips.txt files with duplicates, remove duplicates, and fix missing route_ids
-    # Input: Python open file
+    # Input: Pandas dataframes of trips.txt and routes.txt
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    tritimes = fix_stop_time_file(tri_data)
-    route_data = fix_stop_time_file(rou_data)
     if len(tritimes.index) != len(tritimes.drop_duplicates('trip_id').index):
         return True, tritimes, route_data
     else:
@@ -322,11 +626,11 @@ def check_trips(tri_data, rou_data):
             return False, None, None
 
 
-def check_caldates(caldate_data):
+def check_caldates(caldata):
     # Description: For calendar_dates.txt files with invalid values, fix them
-    # Input: Python open file
+    # Input: Pandas dataframe of calendar_dates.txt
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    caldata = fix_stop_time_file(caldate_data)
+    caldata = caldata.copy()
     caldata["date"] = caldata["date"].astype(int)
     if len(caldata.loc[caldata["date"] > 10000].index) < len(caldata.index):
         return True, caldata
@@ -334,11 +638,10 @@ def check_caldates(caldate_data):
         return False, None
 
 
-def check_routes(routes_data):
+def check_routes(routesdata):
     # Description: For routes.txt files with duplicate ids
-    # Input: Python open file
+    # Input: Pandas dataframe of routes.txt
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    routesdata = fix_stop_time_file(routes_data)
     rlen = len(routesdata.index)
     routesdata = routesdata.drop_duplicates('route_id')
     if len(routesdata.index) < rlen:
@@ -347,12 +650,10 @@ def check_routes(routes_data):
         return False, None
 
 
-def check_stop_ids(s_data, stop_data):
+def check_stop_ids(stdata, stopdata):
     # Description: For stop_times.txt file with invalid stop ids
-    # Input: Python open files (s_data = stops.txt, stop_data = stop_times.txt)
+    # Input: Pandas dataframes (stdata = stops.txt, stopdata = stop_times.txt)
     # Output: Boolean True (if there is an error) or False (if there is no error), and if True, a Pandas dataframe as a second return value, or None if False
-    stdata = fix_stop_time_file(s_data)
-    stopdata = fix_stop_time_file(stop_data)
     all_stop_ids = stdata["stop_id"].unique().tolist()
     stopcheck = stopdata.loc[~stopdata["stop_id"].isin(all_stop_ids)]
     if len(stopcheck.index) > 0 and len(stopcheck.index) < len(stopdata.index):  # Ignores those where datatypes differ between stops.txt and stop_times.txt, could introduce a future error
@@ -361,30 +662,270 @@ def check_stop_ids(s_data, stop_data):
         return False, None, None
 
 
-print()
-print("Correcting GTFS Errors")
-print()
-
-gtfs_path = "data/gtfs-raw"
-data = os.listdir(gtfs_path)
-data = ['/'.join([gtfs_path, x]) for x in data]
-
-for i in range(len(data)):
-    print(data[i])
-    archive = clean_zipfile(data[i])
-    # Check if location_type is in stops.txt
+def check_location_type(archive, log=print):
+    # Description: Checks a cleaned feed for location_type values in stop_times.txt, which may cause the OTP build to fail
+    # Input: zipfile archive, and a function that records progress messages
+    # Output: Boolean True if the feed has the error
     stop_data = archive.open('stops.txt')
     vars = stop_data.readline().decode('utf-8').replace('\n', '').split(',')
     if 'location_type' in vars:
         # Check to make sure all values of location_type in stop_times.txt == 0
+        # Only the header is read, and the location_type column if it is there
         stop_times_data = archive.open('stop_times.txt')
-        stop_df = pd.read_csv(stop_times_data)
-        if 'location_type' in stop_df.columns:
-            print()
-            print("!!!Error that may cause build to fail!!!")
-            print(data[i]["name"], stop_df["location_type"].unique())
-            print("!!!Error that may cause build to fail!!!")
-            print()
-
-print()
-print("Finished! Remember to sync the subdirectory to S3, and move the metadata file as well")
+        stop_cols = pd.read_csv(stop_times_data, nrows=0).columns
+        stop_times_data.close()
+        if 'location_type' in stop_cols:
+            stop_df = pd.read_csv(archive.open('stop_times.txt'), usecols=['location_type'])
+            log("")
+            log("!!!Error that may cause build to fail!!!")
+            log("{} {}".format(archive.filename, stop_df["location_type"].unique()))
+            log("!!!Error that may cause build to fail!!!")
+            log("")
+            return True
+    return False
+
+
+def read_manifest(manifest_path):
+    # Description: Reads the manifest of cleaned feeds
+    # Input: path to manifest json file
+    # Output: dict of raw feed file name to manifest entry, empty if there is no manifest yet
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, manifest_path):
+    # Description: Writes the manifest of cleaned feeds, replacing the old one in a single step
+    # Input: dict of raw feed file name to manifest entry, and path to manifest json file
+    # Output: None
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_cached(entry, path, bounds=None, dates=None, frequency_tolerance=None):
+    # Description: Checks whether a raw feed was already cleaned by this version of the cleaner, with the same pruning
+    #     The raw file is only hashed if its size or modification time changed, e.g. when it was downloaded again
+    # Input: manifest entry for the feed or None, path to the raw zipfile, the pruning bounds and dates or None,
+    #     and the frequency tolerance or None
+    # Output: Boolean True if the clean feed is up to date
+    if entry is None or entry["cleaner_version"] != CLEANER_VERSION:
+        return False
+    if entry.get("bounds") != bounds or entry.get("dates") != (None if dates is None else sorted(map(str, dates))):
+        return False
+    if entry.get("frequency_tolerance") != frequency_tolerance:
+        return False
+    out_path = path.replace('gtfs-raw', 'gtfs-clean')
+    if not os.path.exists(out_path) or os.path.getsize(out_path) != entry["clean_size"]:
+        return False
+    stat = os.stat(path)
+    if stat.st_size == entry["raw_size"] and stat.st_mtime_ns == entry["raw_mtime_ns"]:
+        return True
+    if file_sha256(path) == entry["raw_sha256"]:
+        entry["raw_size"], entry["raw_mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        return True
+    return False
+
+
+def clean_feed(path, agency_index, max_memory=None, columns_path=None, trace_memory=False, sample_interval=None,
+               bounds=None, dates=None, frequency_tolerance=None):
+    # Description: Cleans one feed and collects its messages, for running in a worker process
+    # Input:
+    #   - path: path to zipfile
+    #   - agency_index: number used for the placeholder agency name
+    #   - max_memory: memory ceiling for reading stop_times.txt in bytes, or None for no ceiling
+    #   - columns_path: folder for the columnar caches of the cleaned feeds, or None to not write them
+    #   - trace_memory: Boolean True to record the peak memory of each step
+    #   - sample_interval: seconds between samples of the sampling profiler, or None to not profile
+    #   - bounds: list of south, west, north and east edges to prune the feed to, or None to not prune
+    #   - dates: list of datetime.date to prune the service to, or None to not prune
+    #   - frequency_tolerance: seconds allowed when replacing trips with frequencies.txt, or None to not replace them
+    # Output: path, list of progress messages, the traceback if cleaning failed or None, the manifest entry,
+    #     list of step records, and Counter of profiler samples
+    messages = []
+    stats = StepStats(trace_memory)
+    stats.feed = os.path.basename(path)
+    profiler = SamplingProfiler(sample_interval) if sample_interval else None
+    if profiler is not None:
+        profiler.start()
+    try:
+        stat = os.stat(path)
+        with stats.step("hash_feed", bytes_read=stat.st_size):
+            entry = {"raw_sha256": file_sha256(path), "raw_size": stat.st_size, "raw_mtime_ns": stat.st_mtime_ns,
+                     "cleaner_version": CLEANER_VERSION, "bounds": bounds,
+                     "dates": None if dates is None else sorted(map(str, dates)),
+                     "frequency_tolerance": frequency_tolerance}
+        archive, entry["fixes"] = clean_zipfile(path, agency_index, messages.append, max_memory, stats, bounds,
+                                                dates, frequency_tolerance)
+        with stats.step("check_location_type"):
+            check_location_type(archive, messages.append)
+        chunksize = stop_times_chunksize(archive, 'stop_times.txt', max_memory)
+        archive.close()
+        out_path = path.replace('gtfs-raw', 'gtfs-clean')
+        if columns_path is not None:
+            messages.append("  Writing columnar cache")
+            with stats.step("write_feed_columns", bytes_read=os.path.getsize(out_path)):
+                write_feed_columns(out_path, columns_path, chunksize)
+        with stats.step("hash_feed", bytes_read=os.path.getsize(out_path)):
+            entry["clean_sha256"] = file_sha256(out_path)
+            entry["clean_size"] = os.path.getsize(out_path)
+        error = None
+    except Exception:
+        error, entry = traceback.format_exc(), None
+    finally:
+        samples = profiler.stop() if profiler is not None else None
+        stats.close()
+    return path, messages, error, entry, stats.records, samples
+
+
+def clean_all(gtfs_path, workers=1, force=False, max_memory=None, columns=False, report_path=None,
+              trace_memory=False, sample_interval=None, bounds=None, dates=None, frequency_tolerance=None):
+    # Description: Cleans every feed in a folder, across worker processes if workers is more than 1
+    #     Feeds are sorted by name and numbered in that order, so the output does not depend on scheduling order
+    #     Feeds that are unchanged since the last run are skipped, using the manifest next to the clean folder
+    # Input:
+    #   - gtfs_path: folder of raw GTFS zipfiles
+    #   - workers: number of worker processes
+    #   - force: Boolean True to clean every feed again
+    #   - max_memory: memory ceiling for reading stop_times.txt in bytes, or None for no ceiling
+    #   - columns: Boolean True to also write the columnar cache of each cleaned feed, next to the clean folder
+    #   - report_path: path of the run report, .json or .csv, or None to only print the summary table
+    #   - trace_memory: Boolean True to record the peak memory of each step, which slows down the run
+    #   - sample_interval: seconds between samples of the sampling profiler, or None to not profile. The samples
+    #     are written next to the clean folder as folded stacks, for flamegraph.pl or speedscope
+    #   - bounds: list of south, west, north and east edges from read_bounds to prune every feed to, or None to keep
+    #     all of the service
+    #   - dates: list of datetime.date to keep the service of, or None to keep the service of every date
+    #   - frequency_tolerance: seconds that stop times generated from frequencies.txt may differ from the trips
+    #     they replace, or None to not replace trips. Feeds cleaned with other bounds, dates or tolerance are
+    #     cleaned again
+    # Output: list of (path, traceback) for feeds that failed
+    clean_path = gtfs_path.replace('gtfs-raw', 'gtfs-clean')
+    manifest_path = clean_path + "-manifest.json"
+    columns_path = clean_path + "-columns" if columns else None
+    manifest = read_manifest(manifest_path)
+    names = sorted(os.listdir(gtfs_path))
+    # Evict feeds whose raw file is gone, along with their clean copy
+    for name in sorted(set(manifest) - set(names)):
+        print("Removing stale feed {}".format(name))
+        if os.path.exists('/'.join([clean_path, name])):
+            os.remove('/'.join([clean_path, name]))
+        if columns_path is not None and os.path.exists(columns_folder(name, columns_path)):
+            shutil.rmtree(columns_folder(name, columns_path))
+        del manifest[name]
+    data = []
+    indexes = []
+    for i, name in enumerate(names):
+        path = '/'.join([gtfs_path, name])
+        if not force and is_cached(manifest.get(name), path, bounds, dates, frequency_tolerance):
+            print(path)
+            print("  Unchanged since last run, skipping")
+            out_path = '/'.join([clean_path, name])
+            if columns_path is not None and not columns_up_to_date(out_path, columns_path):
+                print("  Writing columnar cache")
+                write_feed_columns(out_path, columns_path)
+        else:
+            data.append(path)
+            indexes.append(i)
+    options = [[max_memory] * len(data), [columns_path] * len(data), [trace_memory] * len(data),
+               [sample_interval] * len(data), [bounds] * len(data), [dates] * len(data),
+               [frequency_tolerance] * len(data)]
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(clean_feed, data, indexes, *options)
+    else:
+        executor = None
+        results = map(clean_feed, data, indexes, *options)
+    errors = []
+    records = []
+    samples = collections.Counter()
+    try:
+        # Reported in feed order as each feed finishes
+        for path, messages, error, entry, feed_records, feed_samples in results:
+            records.extend(feed_records)
+            samples.update(feed_samples or {})
+            print(path)
+            for line in messages:
+                print(line)
+            if error is not None:
+                print("  Failed to clean feed")
+                errors.append((path, error))
+                manifest.pop(os.path.basename(path), None)
+            else:
+                manifest[os.path.basename(path)] = entry
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        write_manifest(manifest, manifest_path)
+    if records:
+        print()
+        print("Time, rows and memory by step")
+        print(summary_table(records).to_string(index=False))
+        if report_path is not None:
+            write_report(records, report_path)
+            print("Run report written to {}".format(report_path))
+    if samples:
+        write_folded(samples, clean_path + "-profile.folded")
+        print()
+        print("Hot spots, by samples taken in each function")
+        print(top_functions(samples).to_string(index=False))
+        print("Profile written to {}".format(clean_path + "-profile.folded"))
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correct all GTFS feeds in data/gtfs-raw")
+    parser.add_argument("--workers", type=int, default=1, help="number of feeds to clean in parallel")
+    parser.add_argument("--force", action="store_true", help="clean every feed again, even if it is unchanged")
+    parser.add_argument("--max-memory", type=float, default=None,
+                        help="memory ceiling in MB for each stop_times.txt, larger files are processed in chunks")
+    parser.add_argument("--columns", action="store_true",
+                        help="also write a memory-mapped columnar copy of each cleaned feed to data/gtfs-clean-columns")
+    parser.add_argument("--report", default="data/gtfs-clean-report.json",
+                        help="run report with the time, rows, bytes and peak memory of each step, .json or .csv")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record the peak memory of each step, which can make the run several times slower")
+    parser.add_argument("--sample-profile", type=float, default=0, metavar="MS",
+                        help="sample the call stack every MS milliseconds of CPU time, and write the hot spots to "
+                             "data/gtfs-clean-profile.folded")
+    parser.add_argument("--prune", nargs="?", const="osm_bounds.json", default=None, metavar="BOUNDS",
+                        help="drop the stops outside the bounding box that the OSM extract is clipped to "
+                             "(osm_bounds.json if no file is given), along with the trips, routes, shapes and "
+                             "services that are left unused")
+    parser.add_argument("--prune-buffer", type=float, default=5, metavar="KM",
+                        help="distance in km added around the bounding box when pruning")
+    parser.add_argument("--service-dates", nargs="*", default=None, metavar="DATE",
+                        help="keep only the trips that run on these YYYY-MM-DD dates, by default the analysis dates "
+                             "2021-09-15 and 2021-09-19 of access_analysis.R, and rewrite the calendar to them")
+    parser.add_argument("--frequencies", nargs="?", type=float, const=0, default=None, metavar="SECONDS",
+                        help="replace trips that repeat at an even headway with frequencies.txt, allowing their stop "
+                             "times to move by up to SECONDS (0 if not given)")
+    args = parser.parse_args()
+
+    print()
+    print("Correcting GTFS Errors")
+    print()
+
+    gtfs_path = "data/gtfs-raw"
+    max_memory = None if args.max_memory is None else int(args.max_memory * 1e6)
+    sample_interval = args.sample_profile / 1000 if args.sample_profile > 0 else None
+    bounds = None if args.prune is None else read_bounds(args.prune, args.prune_buffer * 1000)
+    dates = None
+    if args.service_dates is not None:
+        dates = [datetime.datetime.strptime(x, "%Y-%m-%d").date()
+                 for x in args.service_dates or ["2021-09-15", "2021-09-19"]]
+    errors = clean_all(gtfs_path, args.workers, args.force, max_memory, args.columns, args.report,
+                       args.trace_memory, sample_interval, bounds, dates, args.frequencies)
+
+    if errors:
+        print()
+        print("!!!{} feeds could not be cleaned!!!".format(len(errors)))
+        for path, error in errors:
+            print(path)
+            print(error)
+        sys.exit(1)
+
+    print()
+    print("Finished! Remember to sync the subdirectory to S3, and move the metadata file as well")
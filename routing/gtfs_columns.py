@@ -0,0 +1,167 @@
+# Columnar cache of cleaned GTFS feeds, as memory-mapped numpy arrays
+
+import json
+import os
+import shutil
+import zipfile
+import numpy as np
+import pandas as pd
+from gtfs_tables import file_sha256, iter_gtfs_table, read_gtfs_table
+
+COLUMNS_VERSION = 1  # Increase when the layout of the folder changes
+
+
+def columns_folder(zip_path, columns_path):
+    # Description: Location of the columnar cache of a feed
+    # Input: path to cleaned zipfile, and folder that holds the columnar caches of all feeds
+    # Output: path to the folder of the feed
+    return os.path.join(columns_path, os.path.basename(zip_path))
+
+
+def _append_chunk(chunk, stem, folder, meta, lookups):
+    # Description: Appends one chunk of a table to the column files
+    # Input:
+    #   - chunk: pandas dataframe read by read_gtfs_table or iter_gtfs_table
+    #   - stem: table name without .txt, used as prefix of the column files
+    #   - folder: folder of the feed
+    #   - meta: dict describing the table, updated in place
+    #   - lookups: dict of column name to dict of value to code, for the dictionary encoded columns
+    # Output: None
+    meta["rows"] += len(chunk.index)
+    for name in chunk.columns:
+        column = chunk[name]
+        if name not in meta["columns"]:
+            if pd.api.types.is_integer_dtype(column.dtype):
+                meta["columns"][name] = {"kind": "integer", "dtype": column.dtype.numpy_dtype.name}
+            elif pd.api.types.is_float_dtype(column.dtype):
+                meta["columns"][name] = {"kind": "float", "dtype": "float64"}
+            else:
+                meta["columns"][name] = {"kind": "dictionary", "dtype": "int32", "categories": []}
+                lookups[name] = {}
+        info = meta["columns"][name]
+        path = os.path.join(folder, "{}.{}".format(stem, name))
+        if info["kind"] == "integer":
+            values = column.astype(info["dtype"].capitalize())
+            with open(path + ".bin", "ab") as f:
+                f.write(values.fillna(0).values.astype(info["dtype"]).tobytes())
+            with open(path + ".mask.bin", "ab") as f:
+                f.write(values.isnull().values.tobytes())
+        elif info["kind"] == "float":
+            with open(path + ".bin", "ab") as f:
+                f.write(column.values.astype("float64").tobytes())
+        else:
+            # Map the codes of this chunk onto codes shared by the whole table
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                codes, uniques = column.cat.codes.values, column.cat.categories
+            else:
+                codes, uniques = pd.factorize(column.values)
+            lookup = lookups[name]
+            for value in uniques:
+                if value not in lookup:
+                    lookup[value] = len(info["categories"])
+                    info["categories"].append(str(value))
+            shared = np.append(np.array([lookup[x] for x in uniques], dtype=np.int32), -1)[codes]
+            with open(path + ".bin", "ab") as f:
+                f.write(shared.astype(np.int32).tobytes())
+
+
+def write_feed_columns(zip_path, columns_path, chunksize=None):
+    # Description: Builds the columnar cache of a cleaned feed from its zipfile
+    #     There is one raw array file per column: text columns (ids, names) are dictionary encoded as int32 codes,
+    #     times are int32 seconds past midnight, and meta.json records the zipfile the cache was built from.
+    #     The folder is written under a temporary name and moved into place, so readers never see a partial cache
+    # Input:
+    #   - zip_path: path to cleaned zipfile
+    #   - columns_path: folder that holds the columnar caches of all feeds
+    #   - chunksize: number of rows to parse at a time, or None to read each table at once
+    # Output: path to the folder of the feed
+    folder = columns_folder(zip_path, columns_path)
+    tmp_folder = folder + ".tmp"
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    stat = os.stat(zip_path)
+    feed_meta = {"version": COLUMNS_VERSION, "zip_size": stat.st_size, "zip_mtime_ns": stat.st_mtime_ns,
+                 "zip_sha256": file_sha256(zip_path), "tables": {}}
+    with zipfile.ZipFile(zip_path) as archive:
+        for filename in archive.namelist():
+            if not filename.endswith(".txt"):
+                continue
+            stem = filename[:-4]
+            meta = {"rows": 0, "columns": {}}
+            lookups = {}
+            with archive.open(filename) as source:
+                if chunksize is None:
+                    chunks = [read_gtfs_table(source)]
+                else:
+                    chunks = iter_gtfs_table(source, chunksize)
+                for chunk in chunks:
+                    _append_chunk(chunk, stem, tmp_folder, meta, lookups)
+            feed_meta["tables"][filename] = meta
+    with open(os.path.join(tmp_folder, "meta.json"), "w") as f:
+        json.dump(feed_meta, f)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+    return folder
+
+
+def columns_up_to_date(zip_path, columns_path):
+    # Description: Checks whether the columnar cache of a feed was built from the current zipfile
+    #     The zipfile is only hashed if its size or modification time changed
+    # Input: path to cleaned zipfile, and folder that holds the columnar caches of all feeds
+    # Output: Boolean True if the cache can be used
+    meta_path = os.path.join(columns_folder(zip_path, columns_path), "meta.json")
+    if not os.path.exists(meta_path) or not os.path.exists(zip_path):
+        return False
+    with open(meta_path) as f:
+        feed_meta = json.load(f)
+    if feed_meta["version"] != COLUMNS_VERSION:
+        return False
+    stat = os.stat(zip_path)
+    if stat.st_size == feed_meta["zip_size"] and stat.st_mtime_ns == feed_meta["zip_mtime_ns"]:
+        return True
+    return stat.st_size == feed_meta["zip_size"] and file_sha256(zip_path) == feed_meta["zip_sha256"]
+
+
+def _load_table(folder, stem, meta):
+    # Description: Loads one table of the columnar cache as memory maps
+    # Input: folder of the feed, table name without .txt, and dict describing the table
+    # Output: pandas dataframe
+    columns = {}
+    n = meta["rows"]
+    for name, info in meta["columns"].items():
+        path = os.path.join(folder, "{}.{}".format(stem, name))
+        if n == 0:
+            values = np.zeros(0, dtype=info["dtype"])
+        else:
+            values = np.memmap(path + ".bin", dtype=info["dtype"], mode="r", shape=(n,))
+        if info["kind"] == "integer":
+            mask = np.zeros(0, dtype=bool) if n == 0 else np.memmap(path + ".mask.bin", dtype=bool, mode="r", shape=(n,))
+            columns[name] = pd.arrays.IntegerArray(values, mask)
+        elif info["kind"] == "float":
+            columns[name] = values
+        else:
+            columns[name] = pd.Categorical.from_codes(values, pd.Index(info["categories"], dtype=object))
+    return pd.DataFrame(columns)
+
+
+def load_feed_columns(zip_path, columns_path, tables=None, rebuild=True):
+    # Description: Loads tables of a cleaned feed from its columnar cache, rebuilding the cache if the zipfile changed
+    # Input:
+    #   - zip_path: path to cleaned zipfile
+    #   - columns_path: folder that holds the columnar caches of all feeds
+    #   - tables: list of GTFS file names to load, e.g. ["stop_times.txt"], or None for all of them
+    #   - rebuild: Boolean False to return None instead of rebuilding a missing or stale cache
+    # Output: dict of GTFS file name to pandas dataframe, or None
+    if not columns_up_to_date(zip_path, columns_path):
+        if not rebuild:
+            return None
+        write_feed_columns(zip_path, columns_path)
+    folder = columns_folder(zip_path, columns_path)
+    with open(os.path.join(folder, "meta.json")) as f:
+        feed_meta = json.load(f)
+    if tables is None:
+        tables = list(feed_meta["tables"])
+    return {filename: _load_table(folder, filename[:-4], feed_meta["tables"][filename])
+            for filename in tables if filename in feed_meta["tables"]}
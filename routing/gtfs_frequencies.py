@@ -0,0 +1,112 @@
+# Compression of trips that repeat at an even headway into frequencies.txt
+
+import numpy as np
+import pandas as pd
+
+
+def _combine_hashes(hashes, starts):
+    # Description: Combines the hashes of consecutive rows into one hash per group, wrapping around on overflow
+    # Input: numpy uint64 array of row hashes, and numpy array of the first row of each group
+    # Output: numpy uint64 array, one hash per group
+    with np.errstate(over="ignore"):
+        return np.add.reduceat(hashes, starts)
+
+
+def trip_patterns(stimes, tolerance=0):
+    # Description: Hashes the stop pattern of each trip, with its times relative to the first departure of the trip.
+    #     Two trips with the same hash call at the same stops in the same order, with the same relative times and
+    #     the same values in every other column of stop_times.txt. With a tolerance, relative times are rounded to
+    #     multiples of it first, so trips whose times differ by less than the tolerance can share a hash
+    # Input: pandas dataframe of stop_times.txt, and tolerance in seconds
+    # Output: pandas dataframe of trip_id, start in seconds and pattern hash, one row per trip with a start time
+    stimes = stimes.sort_values(["trip_id", "stop_sequence"], kind="mergesort")
+    trip = stimes["trip_id"].astype(object).values
+    first = np.flatnonzero(np.append(True, trip[1:] != trip[:-1])) if len(trip) > 0 else np.zeros(0, dtype=int)
+    n_stops = np.diff(np.append(first, len(trip)))
+    arrival = stimes["arrival_time"].astype(float).values
+    departure = stimes["departure_time"].astype(float).values
+    start = np.where(np.isnan(departure[first]), arrival[first], departure[first])
+    row_start = np.repeat(start, n_stops)
+    relative = pd.DataFrame({"position": np.arange(len(trip)) - np.repeat(first, n_stops),
+                             "arrival": arrival - row_start, "departure": departure - row_start})
+    if tolerance > 0:
+        relative[["arrival", "departure"]] = (relative[["arrival", "departure"]] / tolerance).round()
+    other = stimes.drop(columns=["trip_id", "arrival_time", "departure_time"]).reset_index(drop=True)
+    rows = pd.concat([relative, other], axis=1)
+    hashes = pd.util.hash_pandas_object(rows, index=False).values
+    patterns = pd.DataFrame({"trip_id": trip[first], "start": start, "pattern": _combine_hashes(hashes, first)})
+    return patterns.loc[~np.isnan(start)]
+
+
+def _runs(start, group, tolerance):
+    # Description: Splits the trips of each group, ordered by start time, into runs of an even headway
+    #     A run ends where the headway changes by more than the tolerance
+    # Input: numpy arrays of start times and group numbers, sorted by group then start, and tolerance in seconds
+    # Output: numpy array of run numbers
+    headway = np.diff(start, prepend=np.nan)
+    new_group = np.diff(group, prepend=-1) != 0
+    headway[new_group] = np.nan
+    change = np.abs(np.diff(headway, prepend=np.nan)) > tolerance  # False where either headway is NaN
+    return np.cumsum(new_group | change)
+
+
+def compress_frequencies(stimes, trips, frequencies=None, transfers=None, tolerance=0, min_trips=3):
+    # Description: Replaces runs of trips that only differ by their start time with one template trip and a row of
+    #     frequencies.txt with exact_times 1. The trips of a run share route, service, every other column of
+    #     trips.txt and the hash of their relative stop times, and start at an even headway. Half of the tolerance is
+    #     allowed on the relative times and half on the start times, so no generated stop time is off by more than
+    #     the tolerance. Trips with a block_id, trips already in frequencies.txt and trips named in transfers.txt are left alone
+    # Input:
+    #   - stimes: pandas dataframe of stop_times.txt
+    #   - trips: pandas dataframe of trips.txt
+    #   - frequencies: pandas dataframe of frequencies.txt, or None
+    #   - transfers: pandas dataframe of transfers.txt, or None
+    #   - tolerance: largest difference in seconds allowed between a trip's times and the times of the trip that
+    #     frequencies.txt generates in its place
+    #   - min_trips: smallest number of trips worth replacing
+    # Output: pandas dataframes of stop_times.txt, trips.txt and frequencies.txt, and the number of trips removed
+    patterns = trip_patterns(stimes, tolerance / 2)
+    fixed = set()
+    if "block_id" in trips.columns:
+        fixed.update(trips.loc[trips["block_id"].notnull().values, "trip_id"].astype(object))
+    if frequencies is not None:
+        fixed.update(frequencies["trip_id"].dropna().astype(object))
+    if transfers is not None:
+        for column in ["from_trip_id", "to_trip_id"]:
+            if column in transfers.columns:
+                fixed.update(transfers[column].dropna().astype(object))
+    trip_fields = trips.drop_duplicates("trip_id")
+    trip_fields.index = trip_fields["trip_id"].astype(object).values
+    trip_fields = trip_fields.drop(columns=[c for c in ["trip_id", "block_id"] if c in trips.columns])
+    usable = ~patterns["trip_id"].isin(fixed).values & patterns["trip_id"].isin(trip_fields.index).values
+    patterns = patterns.loc[usable]
+    # Group on the stop pattern and every other field of the trip
+    trip_hash = pd.util.hash_pandas_object(trip_fields.loc[patterns["trip_id"].values], index=False).values
+    with np.errstate(over="ignore"):
+        patterns["key"] = patterns["pattern"].values * np.uint64(31) + trip_hash
+    patterns = patterns.sort_values(["key", "start"], kind="mergesort").reset_index(drop=True)
+    patterns["group"] = pd.factorize(patterns["key"])[0]
+    patterns["run"] = _runs(patterns["start"].values, patterns["group"].values, tolerance / 2)
+    # Headway of each run from its first and last start, kept if every trip is within the tolerance of its slot
+    runs = patterns.groupby("run").agg(template=("trip_id", "first"), first=("start", "min"), last=("start", "max"),
+                                       n=("start", "size"))
+    runs = runs.loc[runs["n"] >= min_trips]
+    runs["headway"] = ((runs["last"] - runs["first"]) / (runs["n"] - 1)).round()
+    members = patterns.loc[patterns["run"].isin(runs.index)]
+    slot = members.groupby("run").cumcount().values
+    run = runs.loc[members["run"].values]
+    error = np.abs(members["start"].values - (run["first"].values + slot * run["headway"].values))
+    late = pd.Series(error > tolerance / 2).groupby(members["run"].values).any()
+    runs = runs.loc[(runs["headway"] > 0) & ~late.reindex(runs.index, fill_value=True)]
+    members = members.loc[members["run"].isin(runs.index).values]
+    removed = members.loc[~members["trip_id"].isin(runs["template"]).values, "trip_id"].values
+    if len(removed) == 0:
+        return stimes, trips, frequencies, 0
+    new_rows = pd.DataFrame({"trip_id": runs["template"].values, "start_time": runs["first"].values,
+                             "end_time": runs["first"].values + runs["n"].values * runs["headway"].values,
+                             "headway_secs": runs["headway"].values.astype(int), "exact_times": 1})
+    if frequencies is not None:
+        new_rows = pd.concat([frequencies.astype({"trip_id": object}), new_rows], ignore_index=True)
+    stimes = stimes.loc[~stimes["trip_id"].isin(removed).values]
+    trips = trips.loc[~trips["trip_id"].isin(removed).values]
+    return stimes, trips, new_rows, len(removed)
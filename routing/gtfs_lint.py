@@ -0,0 +1,219 @@
+# Read-only check of raw GTFS feeds for the errors that correct_gtfs_data_state.py fixes, without building dataframes
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from correct_gtfs_data_state import open_feed
+
+REQUIRED_FILES = ["agency.txt", "stops.txt", "routes.txt", "trips.txt", "stop_times.txt"]
+AGENCY_FIELDS = ["agency_name", "agency_url", "agency_timezone"]
+
+
+def _read(archive, member):
+    # Description: Streams the rows of a GTFS file through the csv module, one row at a time
+    # Input: zipfile archive, and member name
+    # Output: generator of the header as a dict of column name to position, with whitespace trimmed, then one list
+    #     of strings per row
+    with archive.open(member) as source:
+        reader = csv.reader(io.TextIOWrapper(source, encoding="utf-8-sig", newline=""))
+        yield {name.strip(): i for i, name in enumerate(next(reader, []))}
+        yield from reader
+
+
+def _getter(columns, name):
+    # Description: Makes a function that reads one field of a row, trimmed, and blank if the row is too short
+    # Input: header dict from _read, and column name
+    # Output: function of a row, or None if the file has no such column
+    i = columns.get(name)
+    if i is None:
+        return None
+    return lambda row: row[i].strip() if i < len(row) else ""
+
+
+def _id_set(archive, members, filename, column, rows, defects, duplicate_defect=None):
+    # Description: Reads the set of ids of a file, counting rows whose id was already seen
+    # Input: zipfile archive, dict of file name to member name, file name, id column, dict of row counts and dict
+    #     of defect counts to update, and the name of the defect for duplicate ids or None
+    # Output: set of ids, empty if the file or column is missing
+    ids = set()
+    if filename not in members:
+        return ids
+    reader = _read(archive, members[filename])
+    get_id = _getter(next(reader), column)
+    n = 0
+    for row in reader:
+        n += 1
+        if get_id is not None:
+            ids.add(get_id(row))
+    rows[filename] = n
+    if duplicate_defect is not None and n > len(ids):
+        defects[duplicate_defect] = defects.get(duplicate_defect, 0) + n - len(ids)
+    return ids
+
+
+def lint_feed(path):
+    # Description: Checks a raw feed for every error that clean_zipfile fixes, and for location_type in
+    #     stop_times.txt, which check_location_type warns may make the OTP build fail. Each file is streamed once,
+    #     keeping only sets of ids and the last stop of each trip. The defects are named like the fixes in the manifest
+    #     and counted in rows, except final_stop_times, which counts trips. As in clean_zipfile, stop ids are only
+    #     an error if some stop times have a valid one, and final stop times are checked on the valid rows
+    # Input: path to raw zipfile
+    # Output: dict with feed, layout fixes, missing required files, defect counts, rows per file, build_may_fail,
+    #     seconds and the traceback if the feed could not be read, or None
+    t0 = time.perf_counter()
+    result = {"feed": os.path.basename(path), "layout": [], "missing_files": [], "defects": {}, "rows": {},
+              "build_may_fail": False, "seconds": None, "error": None}
+    defects, rows = result["defects"], result["rows"]
+    try:
+        archive, members, result["layout"] = open_feed(path, log=lambda message: None)
+        result["missing_files"] = [f for f in REQUIRED_FILES if f not in members]
+        # agency.txt: required fields blank or missing, or lines with different numbers of commas
+        if "agency.txt" in members:
+            with archive.open(members["agency.txt"]) as source:
+                lines = source.read().decode("utf-8-sig").splitlines()
+            reader = csv.reader(lines)
+            columns = {name.strip(): i for i, name in enumerate(next(reader, []))}
+            getters = [_getter(columns, field) for field in AGENCY_FIELDS]
+            n_rows = 0
+            n_missing = 0
+            for row in reader:
+                n_rows += 1
+                n_missing += any(get is None or not get(row) for get in getters)
+            rows["agency.txt"] = n_rows
+            if n_missing or len(set(len(line.split(',')) for line in lines)) > 1:
+                defects["agency"] = max(n_missing, 1)
+        stop_ids = _id_set(archive, members, "stops.txt", "stop_id", rows, defects)
+        route_ids = _id_set(archive, members, "routes.txt", "route_id", rows, defects, "routes")
+        # trips.txt: duplicate trip ids, and route ids that are not in routes.txt
+        if "trips.txt" in members:
+            reader = _read(archive, members["trips.txt"])
+            columns = next(reader)
+            get_trip, get_route = _getter(columns, "trip_id"), _getter(columns, "route_id")
+            trip_ids = set()
+            n_rows = 0
+            n_unknown = 0
+            for row in reader:
+                n_rows += 1
+                trip_ids.add(get_trip(row))
+                n_unknown += get_route(row) not in route_ids
+            rows["trips.txt"] = n_rows
+            if n_rows > len(trip_ids) or n_unknown:
+                defects["trips"] = n_rows - len(trip_ids) + n_unknown
+        # stop_times.txt: stop ids that are not in stops.txt, and trips whose last stop has no time
+        if "stop_times.txt" in members:
+            reader = _read(archive, members["stop_times.txt"])
+            columns = next(reader)
+            i_trip, i_stop, i_seq = columns["trip_id"], columns["stop_id"], columns["stop_sequence"]
+            i_arr, i_dep = columns.get("arrival_time", -1), columns.get("departure_time", -1)
+            width = max(i_trip, i_stop, i_seq, i_arr, i_dep) + 1
+            last = {}  # trip_id to (largest stop_sequence, True if that stop has no time)
+            n_rows = 0
+            n_invalid = 0
+            for row in reader:
+                n_rows += 1
+                if len(row) < width:
+                    row = row + [""] * (width - len(row))
+                if row[i_stop].strip() not in stop_ids:
+                    n_invalid += 1
+                    continue
+                try:
+                    seq = float(row[i_seq])
+                except ValueError:
+                    continue
+                trip = row[i_trip].strip()
+                untimed = (i_arr < 0 or not row[i_arr].strip()) and (i_dep < 0 or not row[i_dep].strip())
+                known = last.get(trip)
+                if known is None or seq > known[0] or (seq == known[0] and untimed):
+                    last[trip] = (seq, untimed)
+            rows["stop_times.txt"] = n_rows
+            if 0 < n_invalid < n_rows:
+                defects["stop_ids"] = n_invalid
+            n_untimed = sum(untimed for seq, untimed in last.values())
+            if n_untimed:
+                defects["final_stop_times"] = n_untimed
+            # check_location_type: location_type in both stops.txt and stop_times.txt
+            if "stops.txt" in members and "location_type" in columns:
+                result["build_may_fail"] = "location_type" in next(_read(archive, members["stops.txt"]))
+        # transfers.txt: blank transfer_type
+        if "transfers.txt" in members:
+            reader = _read(archive, members["transfers.txt"])
+            get_type = _getter(next(reader), "transfer_type")
+            n_rows = 0
+            n_blank = 0
+            for row in reader:
+                n_rows += 1
+                n_blank += get_type is not None and not get_type(row)
+            rows["transfers.txt"] = n_rows
+            if n_blank:
+                defects["transfers"] = n_blank
+        # calendar_dates.txt: dates that are not YYYYMMDD
+        if "calendar_dates.txt" in members:
+            reader = _read(archive, members["calendar_dates.txt"])
+            get_date = _getter(next(reader), "date")
+            n_rows = 0
+            n_bad = 0
+            for row in reader:
+                n_rows += 1
+                try:
+                    n_bad += float(get_date(row)) <= 10000
+                except (TypeError, ValueError):
+                    n_bad += 1
+            rows["calendar_dates.txt"] = n_rows
+            if n_bad:
+                defects["calendar_dates"] = n_bad
+        # pathways.txt: pathway_mode in place of pathway_type, only the header is read
+        if "pathways.txt" in members and "pathway_mode" in next(_read(archive, members["pathways.txt"])):
+            defects["pathways"] = 1
+        archive.close()
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["seconds"] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+def lint_all(gtfs_path, workers=1):
+    # Description: Checks every feed in a folder, across worker processes if workers is more than 1
+    # Input: folder of raw GTFS zipfiles, and number of worker processes
+    # Output: list of dicts from lint_feed, in the order of the sorted file names
+    paths = ['/'.join([gtfs_path, name]) for name in sorted(os.listdir(gtfs_path)) if name.endswith(".zip")]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lint_feed, paths))
+    return [lint_feed(path) for path in paths]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the feeds in data/gtfs-raw for the errors that "
+                                                 "correct_gtfs_data_state.py fixes, without changing them")
+    parser.add_argument("--workers", type=int, default=1, help="number of feeds to check in parallel")
+    parser.add_argument("--out", default="data/gtfs-raw-lint.json", help="JSON file of the results, one per feed")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    results = lint_all("data/gtfs-raw", args.workers)
+    tmp_path = args.out + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmp_path, args.out)
+    for result in results:
+        fixes = result["layout"] + ["{} ({})".format(name, n) for name, n in result["defects"].items()]
+        print("{}: {}".format(result["feed"], ", ".join(fixes) or "no fixes needed"))
+        if result["missing_files"]:
+            print("  missing {}".format(", ".join(result["missing_files"])))
+        if result["build_may_fail"]:
+            print("  !!!location_type in stop_times.txt, error that may cause build to fail!!!")
+        if result["error"] is not None:
+            print("  could not be read")
+            print(result["error"])
+    print()
+    print("{} feeds checked in {:.1f} s, {} need fixes, results written to {}".format(
+        len(results), time.perf_counter() - t0,
+        sum(bool(r["layout"] or r["defects"]) for r in results), args.out))
+    if any(r["error"] is not None or r["build_may_fail"] or r["missing_files"] for r in results):
+        sys.exit(1)
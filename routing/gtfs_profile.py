@@ -0,0 +1,157 @@
+# Timing, row counts and memory of each step of the GTFS cleaning, and a sampling profiler
+
+import collections
+import csv
+import json
+import os
+import signal
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+# Columns of the run report, in order
+REPORT_FIELDS = ["feed", "step", "seconds", "rows_read", "rows_modified", "bytes_read", "bytes_written", "peak_mb"]
+
+
+class StepStats:
+    # Description: Records one row per check, fix, read and write applied to a feed
+    #     Peak memory is the most memory allocated through Python (pandas and numpy included) while the step ran,
+    #     above what was allocated when it started. Steps can be nested, e.g. a read inside a check
+    # Input: Boolean True to trace memory with tracemalloc, which can slow pandas code down several times,
+    #     otherwise peak_mb is left blank
+    #     The feed of the records is set through the feed attribute
+
+    def __init__(self, trace_memory=False):
+        self.feed = None
+        self.records = []
+        self.trace_memory = trace_memory
+        self._stack = []
+        self._started = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    @contextmanager
+    def step(self, name, **fields):
+        # Description: Times the block of code inside the with statement
+        # Input: step name, and starting values of the other REPORT_FIELDS
+        # Output: dict of the record, which the block can update, e.g. with rows_modified
+        record = {field: None for field in REPORT_FIELDS}
+        record.update(fields, feed=self.feed, step=name)
+        frame = {"start": 0, "peak": 0}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame = {"start": current, "peak": current}
+        self._stack.append(frame)
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - t0
+            self._stack.pop()
+            if self.trace_memory:
+                peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                record["peak_mb"] = round((peak - frame["start"]) / 1e6, 3)
+                if self._stack:
+                    self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+            self.records.append(record)
+
+    def close(self):
+        # Description: Stops tracing memory, if this object started it
+        # Input: None
+        # Output: None
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+
+def write_report(records, path):
+    # Description: Writes the run report, as CSV if path ends in .csv and as JSON otherwise
+    # Input: list of record dicts from StepStats, and path to the report
+    # Output: None
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(records, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def summary_table(records):
+    # Description: Totals the run report by step, slowest step first
+    # Input: list of record dicts from StepStats
+    # Output: pandas dataframe
+    report = pd.DataFrame(records, columns=REPORT_FIELDS)
+    summary = report.groupby("step", sort=False).agg(feeds=("feed", "nunique"), seconds=("seconds", "sum"),
+                                                     rows_read=("rows_read", "sum"),
+                                                     rows_modified=("rows_modified", "sum"),
+                                                     mb_read=("bytes_read", "sum"),
+                                                     mb_written=("bytes_written", "sum"),
+                                                     max_peak_mb=("peak_mb", "max"))
+    summary["rows_read"] = summary["rows_read"].astype("int64")
+    summary["rows_modified"] = summary["rows_modified"].astype("int64")
+    summary["mb_read"] = summary["mb_read"] / 1e6
+    summary["mb_written"] = summary["mb_written"] / 1e6
+    summary["share"] = summary["seconds"] / summary["seconds"].sum()
+    return summary.sort_values("seconds", ascending=False).round(3).reset_index()
+
+
+class SamplingProfiler:
+    # Description: Samples the Python call stack at a fixed interval of CPU time, using SIGPROF (Unix only)
+    #     The samples are counted as folded stacks, the input format of flamegraph.pl and speedscope
+    # Input: sampling interval in seconds
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        # Description: Starts sampling the main thread of this process
+        # Input: None
+        # Output: None
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        # Description: Stops sampling
+        # Input: None
+        # Output: Counter of folded stack to number of samples
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        return self.counts
+
+
+def write_folded(counts, path):
+    # Description: Writes folded stacks, one "frame;frame;frame count" line per stack
+    # Input: Counter of folded stack to number of samples, and path to the output file
+    # Output: None
+    with open(path, "w") as f:
+        for stack, n in counts.most_common():
+            f.write("{} {}\n".format(stack, n))
+
+
+def top_functions(counts, n=10):
+    # Description: Finds the functions where the most samples were taken, i.e. the hot spots
+    # Input: Counter of folded stack to number of samples, and number of functions to return
+    # Output: pandas dataframe of function, samples and share of all samples
+    own = collections.Counter()
+    for stack, k in counts.items():
+        own[stack.rsplit(";", 1)[-1]] += k
+    total = max(sum(own.values()), 1)
+    return pd.DataFrame([{"function": name, "samples": k, "share": round(k / total, 3)}
+                         for name, k in own.most_common(n)], columns=["function", "samples", "share"])
@@ -0,0 +1,201 @@
+# Pruning of GTFS feeds down to the stops, trips and services used for routing
+
+import json
+import numpy as np
+import pandas as pd
+
+METERS_PER_DEGREE = 111320  # Length of a degree of latitude
+# Files whose rows refer to stops, trips, routes, shapes or services, and are pruned along with them
+PRUNED_TABLES = ["stops.txt", "trips.txt", "routes.txt", "shapes.txt", "calendar.txt", "calendar_dates.txt",
+                 "frequencies.txt", "transfers.txt", "pathways.txt", "fare_rules.txt"]
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def read_bounds(path, buffer=0):
+    # Description: Reads the bounding box that clip_metros.sh clips the OSM extract to, and widens it by a buffer
+    #     01_get_centroids.R writes the western edge under "e" and the eastern edge under "w", so the edges are
+    #     taken as the smaller and larger of the two
+    # Input: path to osm_bounds.json, and buffer in meters added on every side
+    # Output: list of south, west, north and east edges in degrees
+    with open(path) as f:
+        bounds = {k: float(np.ravel(v)[0]) for k, v in json.load(f).items()}  # jsonlite may write 1-element arrays
+    south, north = min(bounds["s"], bounds["n"]), max(bounds["s"], bounds["n"])
+    west, east = min(bounds["e"], bounds["w"]), max(bounds["e"], bounds["w"])
+    d_lat = buffer / METERS_PER_DEGREE
+    # Degrees of longitude are shortest on the edge furthest from the equator, which gives the widest buffer
+    d_lon = buffer / (METERS_PER_DEGREE * np.cos(np.radians(max(abs(south), abs(north)))))
+    return [round(south - d_lat, 6), round(west - d_lon, 6), round(north + d_lat, 6), round(east + d_lon, 6)]
+
+
+def stops_in_bounds(stops, bounds):
+    # Description: Finds the stops inside a bounding box
+    #     Entrances, nodes and boarding areas without coordinates follow their parent station,
+    #     and the stations of stops inside the box are kept with them
+    # Input: pandas dataframe of stops.txt, and list of south, west, north and east edges in degrees
+    # Output: numpy Boolean array, True for the stops to keep
+    south, west, north, east = bounds
+    lat = stops["stop_lat"].astype(float).values
+    lon = stops["stop_lon"].astype(float).values
+    inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+    if "parent_station" in stops.columns:
+        stop_ids = stops["stop_id"].astype(object).values
+        parents = stops["parent_station"].astype(object).values
+        inside |= (np.isnan(lat) | np.isnan(lon)) & pd.Series(parents).isin(stop_ids[inside]).values
+        inside |= pd.Series(stop_ids).isin(parents[inside]).values
+    return inside
+
+
+def active_service_ids(calendar, calendar_dates, date):
+    # Description: Finds the services that run on a date, from calendar.txt and the exceptions in calendar_dates.txt
+    # Input:
+    #   - calendar: pandas dataframe of calendar.txt, or None
+    #   - calendar_dates: pandas dataframe of calendar_dates.txt, or None
+    #   - date: datetime.date
+    # Output: set of service_ids
+    day = int(date.strftime("%Y%m%d"))
+    active = set()
+    if calendar is not None and len(calendar.index) > 0:
+        runs = ((calendar[WEEKDAYS[date.weekday()]] == 1) & (calendar["start_date"] <= day)
+                & (calendar["end_date"] >= day)).fillna(False).astype(bool)
+        active.update(calendar.loc[runs.values, "service_id"].dropna().astype(str))
+    if calendar_dates is not None and len(calendar_dates.index) > 0:
+        today = calendar_dates.loc[(calendar_dates["date"] == day).fillna(False).astype(bool).values]
+        active.update(today.loc[(today["exception_type"] == 1).fillna(False).astype(bool).values, "service_id"]
+                      .dropna().astype(str))
+        active.difference_update(today.loc[(today["exception_type"] == 2).fillna(False).astype(bool).values,
+                                           "service_id"].dropna().astype(str))
+    return active
+
+
+def active_services(calendar, calendar_dates, dates):
+    # Description: Finds the services that run on each of a list of dates
+    # Input: pandas dataframes of calendar.txt and calendar_dates.txt, or None, and list of datetime.date
+    # Output: pandas dataframe of service_id and date as YYYYMMDD, one row per service running on each date
+    active = [(service_id, int(date.strftime("%Y%m%d"))) for date in sorted(set(dates))
+              for service_id in sorted(active_service_ids(calendar, calendar_dates, date))]
+    return pd.DataFrame(active, columns=["service_id", "date"])
+
+
+def minimal_calendar(active, with_calendar=True):
+    # Description: Builds calendar.txt and calendar_dates.txt that run each service on exactly its dates in active
+    #     Each service runs between its first and last date, on the weekdays of its dates. Other days in that range
+    #     on those weekdays are removed with exceptions, which are only needed when the dates are over a week apart
+    # Input: pandas dataframe from active_services, and Boolean False to only use calendar_dates.txt,
+    #     for feeds without calendar.txt
+    # Output: pandas dataframes of calendar.txt, or None, and calendar_dates.txt
+    if not with_calendar:
+        return None, active.assign(exception_type=1)
+    if len(active.index) == 0:
+        return pd.DataFrame(columns=["service_id"] + WEEKDAYS + ["start_date", "end_date"]), \
+            active.assign(exception_type=1)
+    days = pd.to_datetime(active["date"].astype(str), format="%Y%m%d")
+    runs = pd.crosstab(active["service_id"], days.dt.weekday.values).reindex(columns=range(7), fill_value=0) > 0
+    span = active.groupby("service_id")["date"].agg(["min", "max"]).reindex(runs.index)
+    calendar = pd.DataFrame({"service_id": runs.index})
+    for i, weekday in enumerate(WEEKDAYS):
+        calendar[weekday] = runs[i].values.astype(int)
+    calendar["start_date"], calendar["end_date"] = span["min"].values, span["max"].values
+    # Every day in each service's range that falls on one of its weekdays but is not one of its dates
+    every_day = pd.date_range(days.min(), days.max())
+    dates = pd.DataFrame({"date": every_day.strftime("%Y%m%d").astype(int), "weekday": every_day.weekday})
+    grid = calendar.merge(dates, how="cross")
+    on_weekday = grid[WEEKDAYS].values[np.arange(len(grid.index)), grid["weekday"].values] == 1
+    in_range = (grid["date"] >= grid["start_date"]).values & (grid["date"] <= grid["end_date"]).values
+    grid = grid.loc[on_weekday & in_range]
+    grid = grid.merge(active.assign(scheduled=True), on=["service_id", "date"], how="left")
+    removed = grid.loc[grid["scheduled"].isnull().values, ["service_id", "date"]]
+    return calendar, removed.assign(exception_type=2).reset_index(drop=True)
+
+
+def _endpoint_times(stimes, trimmed, rows):
+    # Description: Times for stops that became the first or last stop of a trip, interpolated by stop_sequence
+    #     between the nearest timed stops of the whole trip
+    # Input: pandas dataframes of stop_times.txt before and after trimming, and index of the rows of trimmed to time
+    # Output: pandas series of seconds, indexed like rows
+    trip_ids = trimmed.loc[rows, "trip_id"].unique()
+    trips = stimes.loc[stimes["trip_id"].isin(trip_ids).values, ["trip_id", "stop_sequence"]]
+    trips["seconds"] = stimes.loc[trips.index, "arrival_time"].fillna(stimes.loc[trips.index, "departure_time"])
+    trips = trips.astype({"stop_sequence": float, "seconds": float})
+    trips = trips.sort_values(["trip_id", "stop_sequence"], kind="mergesort")
+    trips["timed_sequence"] = trips["stop_sequence"].where(trips["seconds"].notnull())
+    grouped = trips.groupby("trip_id", observed=True)[["seconds", "timed_sequence"]]
+    before, after = grouped.ffill(), grouped.bfill()
+    share = ((trips["stop_sequence"] - before["timed_sequence"])
+             / (after["timed_sequence"] - before["timed_sequence"]).replace(0, np.nan))
+    seconds = before["seconds"] + share * (after["seconds"] - before["seconds"])
+    seconds = seconds.fillna(before["seconds"]).fillna(after["seconds"])  # Past the first or last timed stop
+    return seconds.round().loc[rows]
+
+
+def trim_stop_times(stimes, stop_ids):
+    # Description: Cuts each trip down to its stops in a set of stops, and drops trips left with fewer than two stops.
+    #     A stop that becomes the first or last stop of its trip gets a time if it had none, as GTFS requires
+    # Input: pandas dataframe of stop_times.txt, and array of the stop_ids to keep
+    # Output: pandas dataframe of stop_times.txt, the same object if nothing was cut
+    inside = stimes["stop_id"].isin(stop_ids).values
+    if inside.all():
+        return stimes
+    trimmed = stimes.loc[inside]
+    sequence = trimmed.groupby("trip_id", observed=True)["stop_sequence"]
+    n_stops = sequence.transform("size")
+    trimmed = trimmed.loc[(n_stops >= 2).values]
+    sequence = trimmed.groupby("trip_id", observed=True)["stop_sequence"]
+    ends = ((trimmed["stop_sequence"] == sequence.transform("min"))
+            | (trimmed["stop_sequence"] == sequence.transform("max"))).fillna(False).astype(bool)
+    untimed = ends & trimmed["arrival_time"].isnull() & trimmed["departure_time"].isnull()
+    if untimed.any():
+        rows = trimmed.index[untimed.values]
+        seconds = _endpoint_times(stimes, trimmed, rows)
+        trimmed.loc[rows, "arrival_time"] = seconds.values
+        trimmed.loc[rows, "departure_time"] = seconds.values
+    trimmed["arrival_time"] = trimmed["arrival_time"].fillna(trimmed["departure_time"].where(ends.values))
+    trimmed["departure_time"] = trimmed["departure_time"].fillna(trimmed["arrival_time"].where(ends.values))
+    return trimmed
+
+
+def _referenced(table, column, values):
+    # Description: Finds the rows whose value in a column is blank or one of a set of values
+    # Input: pandas dataframe, column name, and array of values, or None to keep every row
+    # Output: numpy Boolean array
+    if values is None or column not in table.columns:
+        return np.ones(len(table.index), dtype=bool)
+    return (table[column].isnull() | table[column].isin(values)).values
+
+
+def cascade_removals(tables, stop_ids, trip_ids):
+    # Description: Removes the rows of the other files that refer to removed stops or trips,
+    #     then the routes, shapes and services that no trip uses any more. Agencies are kept
+    # Input:
+    #   - tables: dict of file name to pandas dataframe, with every file of PRUNED_TABLES in the feed
+    #   - stop_ids: array of the stop_ids to keep, or None to keep every stop
+    #   - trip_ids: array of the trip_ids to keep
+    # Output: dict of file name to pandas dataframe, only for the files that lost rows
+    pruned = {}
+
+    def keep(filename, mask):
+        if not mask.all():
+            pruned[filename] = tables[filename].loc[mask]
+        return pruned.get(filename, tables[filename])
+
+    if stop_ids is not None and "stops.txt" in tables:
+        keep("stops.txt", _referenced(tables["stops.txt"], "stop_id", stop_ids))
+    trips = keep("trips.txt", _referenced(tables["trips.txt"], "trip_id", trip_ids))
+    route_ids = trips["route_id"].dropna().unique()
+    for filename, column, values in [("routes.txt", "route_id", route_ids),
+                                     ("shapes.txt", "shape_id",
+                                      trips["shape_id"].dropna().unique() if "shape_id" in trips.columns else None),
+                                     ("calendar.txt", "service_id", trips["service_id"].dropna().unique()),
+                                     ("calendar_dates.txt", "service_id", trips["service_id"].dropna().unique()),
+                                     ("frequencies.txt", "trip_id", trip_ids),
+                                     ("fare_rules.txt", "route_id", route_ids)]:
+        if filename in tables:
+            keep(filename, _referenced(tables[filename], column, values))
+    for filename in ["transfers.txt", "pathways.txt"]:
+        if filename in tables:
+            table = tables[filename]
+            mask = _referenced(table, "from_stop_id", stop_ids) & _referenced(table, "to_stop_id", stop_ids)
+            for column, values in [("from_trip_id", trip_ids), ("to_trip_id", trip_ids),
+                                   ("from_route_id", route_ids), ("to_route_id", route_ids)]:
+                mask &= _referenced(table, column, values)
+            keep(filename, mask)
+    return pruned
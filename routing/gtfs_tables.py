@@ -0,0 +1,188 @@
+# Typed reading and writing of GTFS tables
+
+import csv
+import hashlib
+import io
+import numpy as np
+import pandas as pd
+
+# Ids and other repetitive fields, read as categoricals
+ID_COLUMNS = ["agency_id", "stop_id", "parent_station", "zone_id", "level_id", "route_id", "service_id", "trip_id",
+              "block_id", "shape_id", "from_stop_id", "to_stop_id", "from_route_id", "to_route_id", "from_trip_id",
+              "to_trip_id", "pathway_id", "fare_id", "trip_headsign", "stop_headsign"]
+# Times, read as seconds past midnight
+TIME_COLUMNS = ["arrival_time", "departure_time", "start_time", "end_time"]
+# Integer and decimal fields, with the smallest type that holds all valid values
+NUMERIC_COLUMNS = {"stop_sequence": "Int32", "shape_pt_sequence": "Int32", "route_sort_order": "Int32",
+                   "date": "Int32", "start_date": "Int32", "end_date": "Int32", "headway_secs": "Int32",
+                   "min_transfer_time": "Int32", "traversal_time": "Int32", "route_type": "Int16",
+                   "location_type": "Int8", "wheelchair_boarding": "Int8", "wheelchair_accessible": "Int8",
+                   "bikes_allowed": "Int8", "direction_id": "Int8", "pickup_type": "Int8", "drop_off_type": "Int8",
+                   "continuous_pickup": "Int8", "continuous_drop_off": "Int8", "timepoint": "Int8",
+                   "transfer_type": "Int8", "exception_type": "Int8", "exact_times": "Int8", "pathway_mode": "Int8",
+                   "pathway_type": "Int8", "is_bidirectional": "Int8", "monday": "Int8", "tuesday": "Int8",
+                   "wednesday": "Int8", "thursday": "Int8", "friday": "Int8", "saturday": "Int8", "sunday": "Int8",
+                   "stop_lat": "float64", "stop_lon": "float64", "shape_pt_lat": "float64", "shape_pt_lon": "float64",
+                   "shape_dist_traveled": "float64"}
+
+
+def file_sha256(path):
+    # Description: Hashes a file in blocks, without reading it into memory
+    # Input: path to file
+    # Output: hex digest
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_gtfs_time(times):
+    # Description: Converts GTFS HH:MM:SS times to integer seconds past midnight, hours may be 24 or more
+    #     Times are zero padded to a fixed width and the digits are read straight from the bytes
+    # Input: pandas series of time strings, blank or missing for no time
+    # Output: numpy float array of seconds, NaN where there is no time
+    padded = times.fillna('').astype(str).str.strip().str.zfill(8).values.astype('S8')
+    digits = padded.view(np.uint8).reshape(-1, 8).astype(np.int64) - ord('0')
+    colon = ord(':') - ord('0')
+    valid = (digits[:, 2] == colon) & (digits[:, 5] == colon) & (np.char.str_len(padded) == 8)
+    seconds = ((digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60
+               + digits[:, 6] * 10 + digits[:, 7]).astype(float)
+    seconds[~valid] = np.nan
+    return seconds
+
+
+def format_gtfs_time(seconds):
+    # Description: Converts seconds past midnight to GTFS HH:MM:SS times, without wrapping past midnight
+    #     Each distinct time is formatted once and mapped back through the codes. Times before 100:00:00 are written
+    #     digit by digit into fixed width bytes, the reverse of parse_gtfs_time
+    # Input: numpy array or pandas series of seconds, NaN or NA for no time
+    # Output: pandas series of time strings, blank where there is no time
+    codes, uniques = pd.factorize(pd.Series(seconds, dtype="float64"))
+    uniques = np.asarray(uniques, dtype=np.int64)
+    hours, minutes, secs = uniques // 3600, uniques // 60 % 60, uniques % 60
+    if len(uniques) == 0 or (uniques.min() >= 0 and hours.max() < 100):
+        colon = np.full(len(uniques), ord(':') - ord('0'))
+        digits = np.stack([hours // 10, hours % 10, colon, minutes // 10, minutes % 10, colon, secs // 10, secs % 10],
+                          axis=1) + ord('0')
+        text = digits.astype(np.uint8).view('S8').ravel().astype(str).astype(object)
+    else:
+        text = (pd.Series(hours).astype(str).str.zfill(2) + ':' + pd.Series(minutes).astype(str).str.zfill(2) + ':'
+                + pd.Series(secs).astype(str).str.zfill(2)).values
+    times = np.append(text, '')[codes]  # code -1 (missing) picks the blank
+    return pd.Series(times, dtype=object)
+
+
+def _to_integer(values, dtype, index):
+    # Description: Converts a float array with whole values to a nullable integer series, without checking each value
+    # Input: numpy float array, pandas nullable integer type name, and the index of the series
+    # Output: pandas series
+    missing = np.isnan(values)
+    values = np.where(missing, 0, values).astype(dtype.lower())
+    return pd.Series(pd.arrays.IntegerArray(values, missing), index=index)
+
+
+def _convert_column(column, name):
+    # Description: Converts a column of raw strings to its GTFS type
+    #     Whitespace is trimmed and values are parsed once per distinct value, then mapped back through the codes
+    # Input: pandas series of strings, and the column name
+    # Output: pandas series
+    if name in NUMERIC_COLUMNS and column.dtype == "float64":
+        if NUMERIC_COLUMNS[name] == "float64" or np.any(column.values[column.notnull().values] % 1 != 0):
+            return column  # Non-integer values in an integer field are kept as decimals
+        return _to_integer(column.values, NUMERIC_COLUMNS[name], column.index)
+    codes, uniques = pd.factorize(column.values)
+    values = pd.Series(uniques, dtype=object).str.strip()
+    if name in TIME_COLUMNS:
+        parsed = np.append(parse_gtfs_time(values), np.nan)[codes]  # code -1 (missing) picks the trailing NaN
+        return _to_integer(parsed, "Int32", column.index)
+    if name in NUMERIC_COLUMNS:
+        parsed = np.append(pd.to_numeric(values, errors='coerce'), np.nan).astype(float)[codes]
+        if NUMERIC_COLUMNS[name] == "float64" or np.any(parsed[~np.isnan(parsed)] % 1 != 0):
+            return pd.Series(parsed, index=column.index)  # Non-integer values in an integer field are kept as decimals
+        return _to_integer(parsed, NUMERIC_COLUMNS[name], column.index)
+    if name in ID_COLUMNS:
+        # Values that only differ by whitespace are merged into one category
+        new_codes, uniques = pd.factorize(values.replace('', np.nan))
+        codes = np.append(new_codes, -1)[codes]
+        return pd.Series(pd.Categorical.from_codes(codes, uniques), index=column.index)
+    return pd.Series(np.append(values.replace('', np.nan).values, np.nan)[codes], index=column.index)
+
+
+def _read_header(source):
+    # Description: Reads the header line of a GTFS file
+    # Input: Python open file, in binary mode
+    # Output: list of column names, with whitespace trimmed
+    header = source.readline().decode('utf-8-sig')
+    return [x.strip() for x in next(csv.reader([header]))]
+
+
+def read_gtfs_table(source):
+    # Description: Reads a GTFS file with the types of the standard GTFS columns
+    #     Ids are categoricals, times are seconds past midnight, whitespace is trimmed from all fields,
+    #     and blank fields are missing
+    # Input: Python open file, in binary mode
+    # Output: pandas dataframe
+    names = _read_header(source)
+    # Numeric fields are parsed by the C parser, which skips surrounding whitespace, falling back to strings
+    # if a field has text in it
+    dtypes = {name: ("float64" if name in NUMERIC_COLUMNS else str) for name in names}
+    start = source.tell() if source.seekable() else None
+    try:
+        table = pd.read_csv(source, header=None, names=names, dtype=dtypes, keep_default_na=False, na_values=[''],
+                            index_col=False, encoding='utf-8')
+    except ValueError:
+        if start is None:
+            raise
+        source.seek(start)
+        table = pd.read_csv(source, header=None, names=names, dtype=str, keep_default_na=False, na_values=[''],
+                            index_col=False, encoding='utf-8')
+    for name in names:
+        table[name] = _convert_column(table[name], name)
+    return table
+
+
+def iter_gtfs_table(source, chunksize, group_by=None):
+    # Description: Reads a GTFS file in chunks, with the same types as read_gtfs_table
+    #     If group_by is given, a run of rows with the same value is never split across chunks,
+    #     e.g. all stop times of a trip stay together when the file is ordered by trip
+    # Input:
+    #   - source: Python open file, in binary mode
+    #   - chunksize: number of rows to parse at a time
+    #   - group_by: column name, or None
+    # Output: generator of pandas dataframes
+    names = _read_header(source)
+    reader = pd.read_csv(source, header=None, names=names, dtype=str, keep_default_na=False, na_values=[''],
+                         index_col=False, encoding='utf-8', chunksize=chunksize)
+    carry = None
+    for raw in reader:
+        if carry is not None:
+            raw = pd.concat([carry, raw], ignore_index=True)
+        if group_by is not None:
+            # Hold back the last run of rows, it may continue in the next chunk
+            keys = raw[group_by].str.strip()
+            last_run = (keys != keys.iloc[-1]).values.nonzero()[0]
+            split = last_run[-1] + 1 if len(last_run) > 0 else 0
+            raw, carry = raw.iloc[:split], raw.iloc[split:]
+        for name in names:
+            raw[name] = _convert_column(raw[name], name)
+        if len(raw.index) > 0:
+            yield raw
+    if carry is not None and len(carry.index) > 0:
+        for name in names:
+            carry[name] = _convert_column(carry[name], name)
+        yield carry
+
+
+def write_gtfs_table(table, target, header=True):
+    # Description: Writes a GTFS table read by read_gtfs_table back out as text
+    # Input: pandas dataframe, a Python open file in binary mode, and Boolean False to leave out the header line,
+    #     e.g. when writing a table in chunks
+    # Output: None
+    table = table.copy(deep=False)
+    for name in table.columns:
+        if name in TIME_COLUMNS:
+            table[name] = format_gtfs_time(table[name]).values
+    text = io.TextIOWrapper(target, encoding="utf-8", newline="")
+    table.to_csv(text, index=False, header=header)
+    text.detach()  # flushes, and leaves target open for the caller
@@ -0,0 +1,486 @@
+# Transit travel time matrix from the cleaned GTFS feeds, with RAPTOR rounds on numpy arrays
+
+import argparse
+import datetime
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from gtfs_columns import columns_up_to_date, load_feed_columns
+from gtfs_prune import active_service_ids
+from gtfs_tables import read_gtfs_table
+
+# Labels pack an arrival time and the time the traveller left the origin into one int64, so that
+# a single minimum picks the earliest arrival, and among equal arrivals the latest start
+START_BITS = 20
+MASK = (1 << START_BITS) - 1  # Times are seconds after midnight of the service day, well under 2 ** 20
+NEVER = 1 << 30  # Arrival time of stops and tracts that cannot be reached
+INF = NEVER << START_BITS
+EARTH_RADIUS = 6371000  # meters
+FEED_TABLES = ["stops.txt", "trips.txt", "stop_times.txt", "calendar.txt", "calendar_dates.txt", "frequencies.txt"]
+
+_TIMETABLE = None  # Timetable of the worker process, set by _init_worker
+_EGRESS = None  # Walks from stops to destinations of the worker process, set by _init_worker
+
+
+def load_feed(path, columns_path=None):
+    # Description: Reads the tables needed for routing from a cleaned feed, from its columnar cache if it is up to date
+    # Input: path to cleaned zipfile, and folder of the columnar caches or None
+    # Output: dict of GTFS file name to pandas dataframe, without the files that are not in the feed
+    if columns_path is not None and columns_up_to_date(path, columns_path):
+        return load_feed_columns(path, columns_path, FEED_TABLES, rebuild=False)
+    tables = {}
+    with zipfile.ZipFile(path) as archive:
+        for filename in FEED_TABLES:
+            if filename in archive.namelist():
+                with archive.open(filename) as source:
+                    tables[filename] = read_gtfs_table(source)
+    return tables
+
+
+def project(lat, lon, lat0):
+    # Description: Projects coordinates to meters on a plane tangent at latitude lat0, accurate across a metro area
+    # Input: numpy arrays of latitude and longitude in degrees, and latitude of the center of the area
+    # Output: numpy arrays of x and y in meters
+    x = np.radians(np.asarray(lon, dtype=float)) * EARTH_RADIUS * np.cos(np.radians(lat0))
+    y = np.radians(np.asarray(lat, dtype=float)) * EARTH_RADIUS
+    return x, y
+
+
+def pairs_within(xa, ya, xb, yb, radius):
+    # Description: Finds all pairs of points closer than radius, by joining points on a grid of cells of that size
+    # Input: numpy arrays of x and y of the first and second set of points in meters, and distance in meters
+    # Output: numpy arrays of the index in the first set, index in the second set, and distance in meters
+    cells_a = pd.DataFrame({"a": np.arange(len(xa)), "cx": np.floor(xa / radius).astype(np.int64),
+                            "cy": np.floor(ya / radius).astype(np.int64)})
+    cells_b = pd.DataFrame({"b": np.arange(len(xb)), "cx": np.floor(xb / radius).astype(np.int64),
+                            "cy": np.floor(yb / radius).astype(np.int64)})
+    found = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            shifted = cells_b.assign(cx=cells_b["cx"] + dx, cy=cells_b["cy"] + dy)
+            found.append(cells_a.merge(shifted, on=["cx", "cy"])[["a", "b"]])
+    found = pd.concat(found, ignore_index=True)
+    a, b = found["a"].values, found["b"].values
+    dist = np.hypot(xa[a] - xb[b], ya[a] - yb[b])
+    keep = dist <= radius
+    return a[keep], b[keep], dist[keep]
+
+
+def _expand_frequencies(events, frequencies, window):
+    # Description: Replaces each trip of frequencies.txt with one trip per start time inside the time window,
+    #     with the times of the template trip shifted to that start. Start times are start_time plus a multiple
+    #     of headway_secs before end_time, as in OTP
+    # Input: pandas dataframe from _trip_events, pandas dataframe of frequencies.txt, and (start, end) in seconds
+    # Output: pandas dataframe of stop events, ordered by trip and stop_sequence
+    freq = pd.DataFrame({"trip_id": frequencies["trip_id"].astype(str).values,
+                         "start": frequencies["start_time"].astype(float).values,
+                         "end": frequencies["end_time"].astype(float).values,
+                         "headway": frequencies["headway_secs"].astype(float).values}).dropna()
+    freq = freq.loc[freq["trip_id"].isin(set(events["trip_id"])).values & (freq["headway"] > 0).values]
+    if len(freq.index) == 0:
+        return events
+    span = events.groupby("trip_id", sort=False).agg(first=("departure", "first"), last=("arrival", "last"))
+    n = np.ceil((freq["end"] - freq["start"]) / freq["headway"]).clip(lower=0).astype(int).values
+    instances = freq.iloc[np.repeat(np.arange(len(freq.index)), n)].reset_index(drop=True)
+    instances["start"] += (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) * instances["headway"]
+    first = span.loc[instances["trip_id"], "first"].values
+    instances["offset"] = instances["start"].values - first
+    duration = span.loc[instances["trip_id"], "last"].values - first
+    instances = instances.loc[((instances["start"] + duration) >= window[0]).values
+                              & (instances["start"] <= window[1]).values]
+    instances["instance"] = instances["trip_id"] + "#" + np.arange(len(instances.index)).astype(str)
+    expanded = events.merge(instances[["trip_id", "instance", "offset"]], on="trip_id")
+    expanded["arrival"] += expanded["offset"]
+    expanded["departure"] += expanded["offset"]
+    expanded["trip_id"] = expanded["instance"]
+    events = pd.concat([events.loc[~events["trip_id"].isin(set(freq["trip_id"])).values],
+                        expanded[events.columns]], ignore_index=True)
+    return events.sort_values(["trip_id", "stop_sequence"], kind="mergesort").reset_index(drop=True)
+
+
+def _trip_events(tables, feed_key, date, window):
+    # Description: Selects the stop times of the trips that run on a date inside a time window,
+    #     and fills times missing at intermediate stops by interpolating along the trip.
+    #     Trips of frequencies.txt are expanded into one trip per start time
+    # Input: dict of tables of one feed, prefix for its stop and trip ids, datetime.date, and (start, end) in seconds
+    # Output: pandas dataframe with one row per stop event, ordered by trip and stop_sequence
+    stimes = tables.get("stop_times.txt")
+    trips = tables.get("trips.txt")
+    if stimes is None or trips is None or len(stimes.index) == 0:
+        return None
+    services = active_service_ids(tables.get("calendar.txt"), tables.get("calendar_dates.txt"), date)
+    trip_ids = trips.loc[trips["service_id"].astype(str).isin(services).values, "trip_id"].astype(str)
+    events = pd.DataFrame({"trip_id": stimes["trip_id"].astype(str).values,
+                           "stop_id": stimes["stop_id"].astype(str).values,
+                           "stop_sequence": stimes["stop_sequence"].astype(float).values,
+                           "arrival": stimes["arrival_time"].astype(float).values,
+                           "departure": stimes["departure_time"].astype(float).values})
+    events = events.loc[events["trip_id"].isin(set(trip_ids)).values]
+    events = events.sort_values(["trip_id", "stop_sequence"], kind="mergesort").reset_index(drop=True)
+    events["arrival"] = events["arrival"].fillna(events["departure"])
+    events["departure"] = events["departure"].fillna(events["arrival"])
+    # Interpolate between the nearest known times before and after each missing time, within the trip
+    trip_number = np.cumsum((events["trip_id"] != events["trip_id"].shift()).values)
+    known = events["arrival"].notnull().values
+    n = len(events.index)
+    pos = np.arange(n)
+    prev_known = np.maximum.accumulate(np.where(known, pos, -1))
+    next_known = np.minimum.accumulate(np.where(known, pos, n)[::-1])[::-1]
+    ok = ((prev_known >= 0) & (trip_number[np.maximum(prev_known, 0)] == trip_number)
+          & (next_known < n) & (trip_number[np.minimum(next_known, n - 1)] == trip_number))
+    bad_trips = np.unique(trip_number[~ok])  # Trips without a first or last time cannot be placed in the timetable
+    missing = ~known & ok
+    if missing.any():
+        lo, hi = prev_known[missing], next_known[missing]
+        share = (pos[missing] - lo) / (hi - lo)
+        dep_lo = events["departure"].values[lo]
+        filled = dep_lo + share * (events["arrival"].values[hi] - dep_lo)
+        events.loc[missing, "arrival"] = filled
+        events.loc[missing, "departure"] = filled
+    events = events.loc[~np.isin(trip_number, bad_trips)]
+    if tables.get("frequencies.txt") is not None:
+        events = _expand_frequencies(events, tables["frequencies.txt"], window)
+    # Keep trips that are running during the window
+    span = events.groupby("trip_id", sort=False).agg(first=("departure", "min"), last=("arrival", "max"))
+    running = span.index[(span["last"] >= window[0]) & (span["first"] <= window[1])]
+    events = events.loc[events["trip_id"].isin(running)]
+    events["trip_id"] = feed_key + events["trip_id"]
+    events["stop_id"] = feed_key + events["stop_id"]
+    return events
+
+
+def _fifo_groups(dep, arr):
+    # Description: Splits the trips of a stop pattern so that no trip overtakes another, which RAPTOR relies on
+    # Input: 2d numpy arrays of departure and arrival times, one row per trip ordered by first departure
+    # Output: numpy array of the group number of each trip
+    group = np.zeros(len(dep), dtype=np.int64)
+    if len(dep) < 2 or (np.all(np.diff(dep, axis=0) >= 0) and np.all(np.diff(arr, axis=0) >= 0)):
+        return group
+    last_trips = []
+    for t in range(len(dep)):
+        for g, u in enumerate(last_trips):
+            if np.all(dep[t] >= dep[u]) and np.all(arr[t] >= arr[u]):
+                group[t] = g
+                last_trips[g] = t
+                break
+        else:
+            group[t] = len(last_trips)
+            last_trips.append(t)
+    return group
+
+
+def build_timetable(feed_paths, date, window, columns_path=None, transfer_radius=400, walk_speed=1.33, detour=1.3):
+    # Description: Builds the array timetable of all trips that run on a date inside a time window
+    #     Trips that visit the same stops in the same order form a pattern. Each position along a pattern is a column
+    #     of the timetable, holding the departure and arrival times of the pattern's trips in order, so the first
+    #     trip that can be boarded at every position is found with one binary search over all columns
+    # Input:
+    #   - feed_paths: list of paths to cleaned zipfiles
+    #   - date: datetime.date
+    #   - window: (start, end) in seconds after midnight, trips not running in the window are left out
+    #   - columns_path: folder of the columnar caches, or None to read the zipfiles
+    #   - transfer_radius: longest walk between two stops to change vehicles, in meters
+    #   - walk_speed: meters per second
+    #   - detour: ratio of walking distance on streets to straight line distance
+    # Output: dict of numpy arrays
+    stops = []
+    events = []
+    for i, path in enumerate(feed_paths):
+        tables = load_feed(path, columns_path)
+        feed_key = "{}:".format(i)
+        feed_events = _trip_events(tables, feed_key, date, window)
+        if feed_events is not None:
+            events.append(feed_events)
+        feed_stops = tables["stops.txt"]
+        stops.append(pd.DataFrame({"stop_id": feed_key + feed_stops["stop_id"].astype(str).values,
+                                   "lat": feed_stops["stop_lat"].astype(float).values,
+                                   "lon": feed_stops["stop_lon"].astype(float).values}))
+    stops = pd.concat(stops, ignore_index=True).dropna().drop_duplicates("stop_id")
+    events = pd.concat(events, ignore_index=True)
+    # Stops served in the window, numbered
+    events = events.loc[events["stop_id"].isin(stops["stop_id"])]
+    stops = stops.loc[stops["stop_id"].isin(events["stop_id"])].reset_index(drop=True)
+    stop_index = pd.Series(np.arange(len(stops.index)), index=stops["stop_id"])
+    events["stop"] = stop_index.reindex(events["stop_id"]).values
+    # Group trips by their sequence of stops
+    trip_codes, trip_ids = pd.factorize(events["trip_id"], sort=False)
+    bounds = np.flatnonzero(np.diff(trip_codes) != 0) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(trip_codes)]])
+    stop_arr = events["stop"].values.astype(np.int64)
+    keys = [stop_arr[s:e].tobytes() for s, e in zip(starts, ends)]
+    pattern_of_trip, _ = pd.factorize(pd.Series(keys))
+    dep_all = np.round(events["departure"].values).astype(np.int64)
+    arr_all = np.round(events["arrival"].values).astype(np.int64)
+    pattern_stops, col_dep, col_arr, col_start, pattern_start, pattern_trips = [], [], [], [], [], []
+    n_positions = 0
+    n_events = 0
+    order = np.argsort(pattern_of_trip, kind="mergesort")
+    split = np.flatnonzero(np.diff(pattern_of_trip[order]) != 0) + 1
+    for members in np.split(order, split):
+        length = ends[members[0]] - starts[members[0]]
+        if length < 2:
+            continue
+        rows = starts[members][:, None] + np.arange(length)
+        dep, arr = dep_all[rows], arr_all[rows]
+        by_first = np.argsort(dep[:, 0], kind="mergesort")
+        dep, arr = dep[by_first], arr[by_first]
+        groups = _fifo_groups(dep, arr)
+        for g in range(groups.max() + 1):
+            gdep, garr = dep[groups == g], arr[groups == g]
+            pattern_start.append(n_positions)
+            pattern_trips.append(len(gdep))
+            pattern_stops.append(stop_arr[rows[0]])
+            # Column layout: for each position, the times of all trips of the pattern
+            col_dep.append(gdep.T.ravel())
+            col_arr.append(garr.T.ravel())
+            col_start.append(n_events + len(gdep) * np.arange(length))
+            n_positions += length
+            n_events += gdep.size
+    pattern_start = np.array(pattern_start, dtype=np.int64)
+    pattern_trips = np.array(pattern_trips, dtype=np.int64)
+    lengths = np.diff(np.append(pattern_start, n_positions))
+    position_pattern = np.repeat(np.arange(len(pattern_start)), lengths)
+    position_trips = pattern_trips[position_pattern]
+    first = np.zeros(n_positions, dtype=bool)
+    first[pattern_start] = True
+    last = np.zeros(n_positions, dtype=bool)
+    last[pattern_start + lengths - 1] = True
+    col_dep = np.concatenate(col_dep)
+    # Offsets that make a running minimum restart at each pattern, see _scan_patterns
+    span = (pattern_trips.max() + 1) << START_BITS
+    pattern_base = (len(pattern_start) - np.arange(len(pattern_start))) * span
+    x, y = project(stops["lat"].values, stops["lon"].values, stops["lat"].mean())
+    a, b, dist = pairs_within(x, y, x, y, transfer_radius)
+    keep = a != b
+    return {"date": date, "stop_ids": stops["stop_id"].values, "stop_x": x, "stop_y": y, "lat0": stops["lat"].mean(),
+            "position_stop": np.concatenate(pattern_stops), "position_trips": position_trips,
+            "position_base": pattern_base[position_pattern], "position_first": first, "position_last": last,
+            "col_start": np.concatenate(col_start),
+            "col_keys": np.repeat(np.arange(n_positions), position_trips) << START_BITS | col_dep,
+            "col_dep": col_dep, "col_arr": np.concatenate(col_arr),
+            "transfer_from": a[keep], "transfer_to": b[keep],
+            "transfer_time": np.ceil(dist[keep] * detour / walk_speed).astype(np.int64),
+            "walk_speed": walk_speed, "detour": detour}
+
+
+def _scan_patterns(timetable, labels, first_round, transfer_slack):
+    # Description: One RAPTOR round, riding one more vehicle from every stop reached in the previous round
+    #     At each position of each pattern, the earliest trip that can be boarded is found by binary search.
+    #     The trip ridden when arriving at a position is the earliest trip boarded at any position before it,
+    #     a running minimum along the pattern. The minimum runs over all patterns at once: each pattern's values are
+    #     offset to sit below all values of the patterns before it, which restarts the minimum at every pattern
+    # Input: timetable dict, numpy array of labels of the previous round, Boolean True for the first round,
+    #     and seconds needed to change vehicles
+    # Output: numpy array of labels of the stops reached by riding one more vehicle, INF elsewhere
+    stop = timetable["position_stop"]
+    arrival = labels[stop] >> START_BITS
+    start = MASK - (labels[stop] & MASK)
+    ready = np.minimum(arrival + (0 if first_round else transfer_slack), MASK)
+    n_trips = timetable["position_trips"]
+    positions = np.arange(len(stop))
+    trip = np.searchsorted(timetable["col_keys"], positions << START_BITS | ready) - timetable["col_start"]
+    trip = np.where(timetable["position_last"] | (arrival >= NEVER), n_trips, np.minimum(trip, n_trips))
+    boarded = trip < n_trips
+    if first_round:
+        # The traveller can leave the origin just in time for the first vehicle, shortening the wait at the stop
+        dep = timetable["col_dep"][timetable["col_start"] + np.minimum(trip, n_trips - 1)]
+        start = np.where(boarded, dep - (arrival - start), start)
+    key = timetable["position_base"] + (trip << START_BITS) + (MASK - np.clip(start, 0, MASK))
+    riding = np.minimum.accumulate(key)
+    riding = np.concatenate([[0], riding[:-1]])
+    riding -= timetable["position_base"]
+    riding_trip = np.where(timetable["position_first"], n_trips, riding >> START_BITS)
+    riding_start = MASK - (riding & MASK)
+    on_board = riding_trip < n_trips
+    arrive = timetable["col_arr"][timetable["col_start"][on_board] + riding_trip[on_board]]
+    arrivals = np.full(len(labels), INF, dtype=np.int64)
+    np.minimum.at(arrivals, stop[on_board], arrive << START_BITS | (MASK - riding_start[on_board]))
+    return arrivals
+
+
+def egress_walks(timetable, dest_x, dest_y, max_walk=1000):
+    # Description: Finds the walks from stops to destinations, which are the same for every origin
+    # Input: dict from build_timetable, numpy arrays of destinations in meters, and longest walk in meters
+    # Output: numpy arrays of stop number, destination number and walking time in seconds
+    a, b, dist = pairs_within(timetable["stop_x"], timetable["stop_y"], dest_x, dest_y, max_walk / timetable["detour"])
+    return a, b, np.ceil(dist * timetable["detour"] / timetable["walk_speed"]).astype(np.int64)
+
+
+def route_origin(timetable, x, y, departure, dest_x, dest_y, max_walk=1000, rounds=5, transfer_slack=120,
+                 egress=None):
+    # Description: Earliest arrival at every destination when leaving an origin at a departure time
+    #     Walks to stops near the origin, rides up to rounds vehicles with walks between stops in between,
+    #     and walks from stops near each destination. Walking the whole way is used if it is faster
+    # Input:
+    #   - timetable: dict from build_timetable
+    #   - x, y: origin in meters, projected with the timetable's lat0
+    #   - departure: seconds after midnight
+    #   - dest_x, dest_y: numpy arrays of destinations in meters
+    #   - max_walk: longest walk to the first stop, from the last stop, or for the whole trip, in meters
+    #   - rounds: largest number of vehicles ridden
+    #   - transfer_slack: seconds needed to change vehicles
+    #   - egress: walks from egress_walks for the same destinations and max_walk, or None to find them
+    # Output: numpy arrays of arrival time and of the time the traveller leaves the origin, in seconds,
+    #     NaN for destinations that cannot be reached
+    walk_factor = timetable["detour"] / timetable["walk_speed"]  # Seconds per meter of straight line
+    radius = max_walk / timetable["detour"]
+    stop_x, stop_y = timetable["stop_x"], timetable["stop_y"]
+    access = np.hypot(stop_x - x, stop_y - y)
+    near = access <= radius
+    labels = np.full(len(stop_x), INF, dtype=np.int64)
+    labels[near] = (departure + np.ceil(access[near] * walk_factor).astype(np.int64)) << START_BITS | (MASK - departure)
+    # Stops reached by transit are kept apart from stops reached on foot from the origin: only they lead on to
+    # destinations, walking the whole way is the direct walk below. Walks between stops start from a vehicle,
+    # so stops left by vehicle are kept apart too
+    transit = np.full(len(stop_x), INF, dtype=np.int64)
+    ridden = np.full(len(stop_x), INF, dtype=np.int64)
+    for k in range(rounds):
+        arrivals = _scan_patterns(timetable, labels, k == 0, transfer_slack)
+        improved = arrivals < ridden
+        if not improved.any():
+            break
+        ridden = np.minimum(ridden, arrivals)
+        transit = np.minimum(transit, arrivals)
+        edges = improved[timetable["transfer_from"]]
+        np.minimum.at(transit, timetable["transfer_to"][edges],
+                      arrivals[timetable["transfer_from"][edges]] + (timetable["transfer_time"][edges] << START_BITS))
+        labels = np.minimum(labels, transit)
+    dest = np.full(len(dest_x), INF, dtype=np.int64)
+    a, b, walk = egress if egress is not None else egress_walks(timetable, dest_x, dest_y, max_walk)
+    reached = transit[a] < INF
+    np.minimum.at(dest, b[reached], transit[a[reached]] + (walk[reached] << START_BITS))
+    direct = np.hypot(dest_x - x, dest_y - y)
+    walkable = direct <= radius
+    walk_key = (departure + np.ceil(direct * walk_factor).astype(np.int64)) << START_BITS | (MASK - departure)
+    dest = np.where(walkable, np.minimum(dest, walk_key), dest)
+    arrival = (dest >> START_BITS).astype(float)
+    start = (MASK - (dest & MASK)).astype(float)
+    arrival[dest >= INF] = np.nan
+    start[dest >= INF] = np.nan
+    return arrival, start
+
+
+def _init_worker(timetable, egress):
+    # Description: Gives a worker process the timetable and egress walks, once, instead of with every task
+    # Input: timetable dict, and tuple from egress_walks
+    # Output: None
+    global _TIMETABLE, _EGRESS
+    _TIMETABLE, _EGRESS = timetable, egress
+
+
+def _route_task(task):
+    # Description: Routes one origin at every departure time, in a worker process
+    # Input: tuple of origin x, y, list of departures in seconds, destination x and y arrays, and route_origin options
+    # Output: 2d numpy arrays of duration and adjusted duration in minutes, one row per departure
+    x, y, departures, dest_x, dest_y, options = task
+    durations, adjusted = [], []
+    for departure in departures:
+        arrival, start = route_origin(_TIMETABLE, x, y, departure, dest_x, dest_y, egress=_EGRESS, **options)
+        # duration is from leaving the origin, and adj_duration counts half of the wait before leaving, like OTP
+        # with waitAtBeginningFactor 0.5
+        durations.append((arrival - start) / 60)
+        adjusted.append((arrival - departure - 0.5 * (start - departure)) / 60)
+    return np.array(durations), np.array(adjusted)
+
+
+def _mean_reached(minutes):
+    # Description: Averages travel times over departure times, leaving out departures that never arrive
+    # Input: 2d numpy array, one row per departure time, NaN where the destination is not reached
+    # Output: numpy array, NaN where the destination is not reached at any departure time
+    reached = ~np.isnan(minutes)
+    with np.errstate(invalid="ignore"):
+        return np.where(reached, minutes, 0).sum(axis=0) / reached.sum(axis=0)
+
+
+def travel_time_matrix(timetable, origins, destinations, departures, workers=1, **options):
+    # Description: Transit travel times from every origin to every destination, averaged over departure times
+    # Input:
+    #   - timetable: dict from build_timetable
+    #   - origins, destinations: pandas dataframes with geoid, lat and lon columns
+    #   - departures: list of departure times in seconds after midnight
+    #   - workers: number of worker processes, each origin is one task
+    #   - options: keyword arguments of route_origin
+    # Output: pandas dataframe with geoid_start, geoid_end, duration and adj_duration in minutes
+    ox, oy = project(origins["lat"].values, origins["lon"].values, timetable["lat0"])
+    dx, dy = project(destinations["lat"].values, destinations["lon"].values, timetable["lat0"])
+    egress = egress_walks(timetable, dx, dy, options.get("max_walk", 1000))
+    tasks = [(ox[i], oy[i], departures, dx, dy, options) for i in range(len(ox))]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(timetable, egress)) as executor:
+            results = list(executor.map(_route_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+    else:
+        _init_worker(timetable, egress)
+        results = [_route_task(task) for task in tasks]
+    duration = np.array([_mean_reached(d) for d, a in results]).ravel()
+    adj_duration = np.array([_mean_reached(a) for d, a in results]).ravel()
+    return pd.DataFrame({"geoid_start": np.repeat(origins["geoid"].values, len(dx)),
+                         "geoid_end": np.tile(destinations["geoid"].values, len(ox)),
+                         "duration": duration.round(3), "adj_duration": adj_duration.round(3)})
+
+
+def route_pairs_matrix(pairs, feed_paths, departure_times, offsets=(-600, 0, 600), columns_path=None, workers=1,
+                       window_hours=3, **options):
+    # Description: Transit travel times for the tract pairs of route_pairs.csv, on each analysis date
+    # Input:
+    #   - pairs: pandas dataframe with geoid_start, lat_start, lon_start, geoid_end, lat_end, lon_end
+    #   - feed_paths: list of paths to cleaned zipfiles
+    #   - departure_times: list of departure datetimes, one per analysis date
+    #   - offsets: seconds added to each departure time, the results are averaged over them
+    #   - columns_path: folder of the columnar caches, or None to read the zipfiles
+    #   - workers: number of worker processes
+    #   - window_hours: longest trip considered, in hours
+    #   - options: keyword arguments of build_timetable and route_origin
+    # Output: pandas dataframe with geoid_start, geoid_end, date, duration and adj_duration in minutes
+    timetable_options = {k: options.pop(k) for k in ["transfer_radius", "walk_speed", "detour"] if k in options}
+    pairs = pairs.loc[pairs["geoid_start"] != pairs["geoid_end"]]
+    origins = pairs[["geoid_start", "lat_start", "lon_start"]].drop_duplicates("geoid_start")
+    origins.columns = ["geoid", "lat", "lon"]
+    destinations = pairs[["geoid_end", "lat_end", "lon_end"]].drop_duplicates("geoid_end")
+    destinations.columns = ["geoid", "lat", "lon"]
+    results = []
+    for when in departure_times:
+        midnight = datetime.datetime.combine(when.date(), datetime.time())
+        base = int((when - midnight).total_seconds())
+        departures = [base + offset for offset in offsets]
+        window = (min(departures), max(departures) + window_hours * 3600)
+        timetable = build_timetable(feed_paths, when.date(), window, columns_path, **timetable_options)
+        matrix = travel_time_matrix(timetable, origins, destinations, departures, workers, **options)
+        matrix["date"] = when.strftime("%Y-%m-%d")
+        results.append(pairs[["geoid_start", "geoid_end"]].merge(matrix, on=["geoid_start", "geoid_end"], how="left"))
+    return pd.concat(results, ignore_index=True)[["geoid_start", "geoid_end", "date", "duration", "adj_duration"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transit travel times between the tracts in data/route_pairs.csv, "
+                                                 "from the feeds in data/gtfs-clean, without OpenTripPlanner")
+    parser.add_argument("--workers", type=int, default=1, help="number of origins to route in parallel")
+    parser.add_argument("--router-name", default="2021-09-15",
+                        help="only use feeds whose file name contains this, like copy_road_transit_data in "
+                             "conduct_routing.R; blank for all feeds")
+    parser.add_argument("--dates", nargs="+", default=["2021-09-15 17:30:00", "2021-09-19 14:30:00"])
+    parser.add_argument("--offsets", nargs="+", type=float, default=[-10, 0, 10],
+                        help="minutes added to each departure time, the results are averaged over them")
+    parser.add_argument("--max-walk", type=float, default=1000, help="longest walk in meters, as in otp_plan")
+    parser.add_argument("--transfer-radius", type=float, default=400,
+                        help="longest walk between stops to change vehicles, in meters")
+    parser.add_argument("--walk-speed", type=float, default=1.33, help="meters per second")
+    parser.add_argument("--rounds", type=int, default=5, help="largest number of vehicles ridden")
+    parser.add_argument("--out", default="data/all_routes_transit_final.csv")
+    args = parser.parse_args()
+
+    clean_path = "data/gtfs-clean"
+    columns_path = clean_path + "-columns"
+    feed_paths = ['/'.join([clean_path, name]) for name in sorted(os.listdir(clean_path))
+                  if name.endswith(".zip") and args.router_name in name]
+    pairs = pd.read_csv("data/route_pairs.csv", dtype={"geoid_start": str, "geoid_end": str})
+    departure_times = [datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S") for x in args.dates]
+    routes = route_pairs_matrix(pairs, feed_paths, departure_times, [int(x * 60) for x in args.offsets],
+                                columns_path if os.path.isdir(columns_path) else None, args.workers,
+                                max_walk=args.max_walk, transfer_radius=args.transfer_radius,
+                                walk_speed=args.walk_speed, rounds=args.rounds)
+    routes.to_csv(args.out, index=False)
+    print("{} of {} tract pairs reached by transit, written to {}".format(
+        routes["adj_duration"].notnull().sum(), len(routes.index), args.out))
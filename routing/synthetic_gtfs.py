@@ -0,0 +1,194 @@
+# Build synthetic GTFS feeds with the errors that correct_gtfs_data_state.py fixes
+
+import argparse
+import zipfile
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from gtfs_tables import format_gtfs_time
+
+# Errors that can be put into a feed, each one is fixed by a check in clean_zipfile
+DEFECTS = ["orphan_stop_ids", "blank_final_times", "null_transfer_type", "pathway_mode", "missing_agency_fields",
+           "duplicate_trips", "duplicate_routes", "bad_calendar_dates"]
+# Ways of packing the files in the zipfile, each one is fixed by open_feed
+LAYOUTS = ["flat", "subfolder", "nested_zip"]
+
+
+def _pick(rng, n, rate):
+    # Description: Chooses which rows get an error, at least one
+    # Input: numpy random generator, number of rows, and share of rows to choose
+    # Output: sorted numpy array of row numbers
+    k = min(n, max(1, int(n * rate)))
+    return np.sort(rng.choice(n, k, replace=False))
+
+
+def make_feed_tables(n_agencies=1, n_routes=10, trips_per_route=20, stops_per_trip=20, n_stops=None, defects=(),
+                     defect_rate=0.01, seed=0):
+    # Description: Builds the tables of a synthetic GTFS feed
+    #     Every route runs one stop pattern at an even headway, so the trips of a route share their relative times.
+    #     Stops are placed around Arlington, inside the OSM extract used for routing
+    # Input:
+    #   - n_agencies: number of agencies
+    #   - n_routes: number of routes, split evenly across agencies
+    #   - trips_per_route: number of trips on each route
+    #   - stops_per_trip: number of stops on each trip
+    #   - n_stops: number of stops in stops.txt, or None for twice the stops on a trip
+    #   - defects: list of names from DEFECTS to put into the feed
+    #   - defect_rate: share of the rows of a table that get an error, at least one row
+    #   - seed: random seed
+    # Output: dict of GTFS file name to pandas dataframe of strings and numbers
+    unknown = set(defects) - set(DEFECTS)
+    if unknown:
+        raise ValueError("Unknown defects: {}".format(", ".join(sorted(unknown))))
+    rng = np.random.default_rng(seed)
+    n_stops = n_stops or 2 * stops_per_trip
+    if n_stops < stops_per_trip:
+        raise ValueError("n_stops must be at least stops_per_trip")
+    tables = {}
+
+    agency = pd.DataFrame({"agency_id": ["A{}".format(i) for i in range(n_agencies)],
+                           "agency_name": ["Agency {}".format(i) for i in range(n_agencies)],
+                           "agency_url": "https://example.com",
+                           "agency_timezone": "America/New_York"})
+    if "missing_agency_fields" in defects:
+        rows = _pick(rng, n_agencies, defect_rate)
+        agency.loc[rows, "agency_name"] = ""
+        agency.loc[rows[::2], "agency_url"] = ""
+    tables["agency.txt"] = agency
+
+    stop_ids = np.array(["S{}".format(i) for i in range(n_stops)], dtype=object)
+    lat = rng.uniform(38.82, 38.94, n_stops)
+    lon = rng.uniform(-77.17, -77.03, n_stops)
+    tables["stops.txt"] = pd.DataFrame({"stop_id": stop_ids, "stop_name": ["Stop {}".format(i) for i in range(n_stops)],
+                                        "stop_lat": lat.round(6), "stop_lon": lon.round(6)})
+
+    route_ids = np.array(["R{}".format(i) for i in range(n_routes)], dtype=object)
+    routes = pd.DataFrame({"route_id": route_ids, "agency_id": agency["agency_id"].values[np.arange(n_routes) % n_agencies],
+                           "route_short_name": np.arange(n_routes).astype(str), "route_type": 3})
+    if "duplicate_routes" in defects:
+        routes = pd.concat([routes, routes.iloc[_pick(rng, n_routes, defect_rate)]], ignore_index=True)
+    tables["routes.txt"] = routes
+
+    # One stop pattern and one pace per route, and trips that start at an even headway
+    patterns = np.argsort(rng.random((n_routes, n_stops)), axis=1)[:, :stops_per_trip]
+    offsets = np.cumsum(rng.integers(60, 240, (n_routes, stops_per_trip)), axis=1)
+    offsets -= offsets[:, :1]
+    headways = rng.integers(5, 31, n_routes) * 60
+    first = rng.integers(5 * 3600, 8 * 3600, n_routes)
+    n_trips = n_routes * trips_per_route
+    trip_route = np.repeat(np.arange(n_routes), trips_per_route)
+    trip_start = first[trip_route] + np.tile(np.arange(trips_per_route), n_routes) * headways[trip_route]
+    trip_ids = np.array(["T{}".format(i) for i in range(n_trips)], dtype=object)
+    trips = pd.DataFrame({"route_id": route_ids[trip_route],
+                          "service_id": np.where(trip_route % 4 == 3, "WE", "WK"),
+                          "trip_id": trip_ids,
+                          "direction_id": trip_route % 2,
+                          "shape_id": np.array(["SH{}".format(i) for i in range(n_routes)], dtype=object)[trip_route]})
+    if "duplicate_trips" in defects:
+        trips = pd.concat([trips, trips.iloc[_pick(rng, n_trips, defect_rate)]], ignore_index=True)
+    tables["trips.txt"] = trips
+
+    shape_route = np.repeat(np.arange(n_routes), stops_per_trip)
+    shape_stops = patterns.ravel()
+    tables["shapes.txt"] = pd.DataFrame({"shape_id": np.array(["SH{}".format(i) for i in range(n_routes)],
+                                                              dtype=object)[shape_route],
+                                         "shape_pt_lat": lat[shape_stops].round(6),
+                                         "shape_pt_lon": lon[shape_stops].round(6),
+                                         "shape_pt_sequence": np.tile(np.arange(1, stops_per_trip + 1), n_routes)})
+
+    st_trip = np.repeat(np.arange(n_trips), stops_per_trip)
+    st_seq = np.tile(np.arange(stops_per_trip), n_trips)
+    seconds = trip_start[st_trip] + offsets[trip_route[st_trip], st_seq]
+    times = format_gtfs_time(seconds).values
+    st_stops = stop_ids[patterns[trip_route[st_trip], st_seq]]
+    if "blank_final_times" in defects:
+        last = np.arange(n_trips) * stops_per_trip + stops_per_trip - 1
+        times[last[_pick(rng, n_trips, defect_rate)]] = ""
+    if "orphan_stop_ids" in defects:
+        rows = _pick(rng, len(st_stops), defect_rate)
+        st_stops = st_stops.copy()
+        st_stops[rows] = ["X{}".format(i) for i in range(len(rows))]
+    tables["stop_times.txt"] = pd.DataFrame({"trip_id": trip_ids[st_trip], "arrival_time": times,
+                                             "departure_time": times, "stop_id": st_stops,
+                                             "stop_sequence": st_seq + 1})
+
+    # Transfers between consecutive stops of each pattern
+    n_transfers = n_routes * (stops_per_trip - 1)
+    transfer_type = np.where(np.arange(n_transfers) % 5 == 0, "2", "0").astype(object)
+    if "null_transfer_type" in defects:
+        transfer_type[_pick(rng, n_transfers, defect_rate)] = ""
+    tables["transfers.txt"] = pd.DataFrame({"from_stop_id": stop_ids[patterns[:, :-1].ravel()],
+                                            "to_stop_id": stop_ids[patterns[:, 1:].ravel()],
+                                            "transfer_type": transfer_type,
+                                            "min_transfer_time": np.where(transfer_type == "2", "120", "")})
+
+    # OTP expects pathway_type, some agencies publish the older pathway_mode name instead
+    pathways = pd.DataFrame({"pathway_id": ["P{}".format(i) for i in range(min(n_stops - 1, 10))],
+                             "from_stop_id": stop_ids[:min(n_stops - 1, 10)],
+                             "to_stop_id": stop_ids[1:min(n_stops, 11)],
+                             "pathway_type": 1, "is_bidirectional": 1})
+    if "pathway_mode" in defects:
+        pathways = pathways.rename(columns={"pathway_type": "pathway_mode"})
+    tables["pathways.txt"] = pathways
+
+    tables["calendar.txt"] = pd.DataFrame({"service_id": ["WK", "WE"],
+                                           "monday": [1, 0], "tuesday": [1, 0], "wednesday": [1, 0],
+                                           "thursday": [1, 0], "friday": [1, 0], "saturday": [0, 1],
+                                           "sunday": [0, 1], "start_date": 20210101, "end_date": 20211231})
+    caldates = pd.DataFrame({"service_id": ["WK", "WE", "WK", "WE"],
+                             "date": [20210906, 20210906, 20211125, 20211125],
+                             "exception_type": [2, 1, 2, 1]})
+    if "bad_calendar_dates" in defects:
+        caldates = pd.concat([caldates, pd.DataFrame({"service_id": ["WK", "WE"], "date": [0, 915],
+                                                      "exception_type": [1, 2]})], ignore_index=True)
+    tables["calendar_dates.txt"] = caldates
+    return tables
+
+
+def write_feed_zip(tables, path, layout="flat"):
+    # Description: Writes the tables of a feed to a GTFS zipfile
+    # Input:
+    #   - tables: dict of GTFS file name to pandas dataframe
+    #   - path: path of the zipfile to write
+    #   - layout: one of LAYOUTS, "subfolder" puts the files in a folder, "nested_zip" puts a zipfile in the zipfile
+    # Output: None
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout: {}".format(layout))
+    folder = "feed/" if layout == "subfolder" else ""
+    buffer = BytesIO() if layout == "nested_zip" else None
+    with zipfile.ZipFile(buffer or path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for filename, table in tables.items():
+            archive.writestr(folder + filename, table.to_csv(index=False))
+    if buffer is not None:
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("feed.zip", buffer.getvalue())
+
+
+def make_feed(path, layout="flat", **kwargs):
+    # Description: Builds a synthetic GTFS feed and writes it to a zipfile
+    # Input: path of the zipfile to write, one of LAYOUTS, and the keyword arguments of make_feed_tables
+    # Output: dict of GTFS file name to number of rows
+    tables = make_feed_tables(**kwargs)
+    write_feed_zip(tables, path, layout)
+    return {filename: len(table.index) for filename, table in tables.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic GTFS feed, e.g. into data/gtfs-raw")
+    parser.add_argument("path", help="path of the zipfile to write")
+    parser.add_argument("--agencies", type=int, default=1)
+    parser.add_argument("--routes", type=int, default=10)
+    parser.add_argument("--trips-per-route", type=int, default=20)
+    parser.add_argument("--stops-per-trip", type=int, default=20)
+    parser.add_argument("--stops", type=int, default=None, help="number of stops in stops.txt")
+    parser.add_argument("--defects", nargs="*", default=DEFECTS, choices=DEFECTS,
+                        help="errors to put into the feed, all of them by default")
+    parser.add_argument("--defect-rate", type=float, default=0.01)
+    parser.add_argument("--layout", default="flat", choices=LAYOUTS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rows = make_feed(args.path, args.layout, n_agencies=args.agencies, n_routes=args.routes,
+                     trips_per_route=args.trips_per_route, stops_per_trip=args.stops_per_trip, n_stops=args.stops,
+                     defects=args.defects, defect_rate=args.defect_rate, seed=args.seed)
+    for filename, n in rows.items():
+        print("{:<20} {:>10}".format(filename, n))